@@ -1,76 +1,627 @@
-"""A flask of techela."""
+"""A flask of techela.
+
+Nothing happens at import time. Use `create_app' to set up a course and get
+the app, e.g. "python -m techela.app <course-label>" does that.
+"""
+import calendar
+from collections import namedtuple
+import contextvars
 from datetime import datetime
-from email import encoders
-from email.mime.base import MIMEBase
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+import functools
 import glob
 import os
-from pkg_resources import get_distribution
 import json
 import random
+import re
 import shutil
 import smtplib
+import sqlite3
 import subprocess
 import sys
+import threading
 import time
-import urllib
-import numpy as np
-import matplotlib.pyplot as plt
+import traceback
+import urllib.parse
+import urllib.request
+
+from flask import Flask, render_template, redirect, url_for, request, jsonify
+
+from techela.archive import ArchiveStore, sha256_file
+from techela.atomic import write_atomic
+from techela.attachments import (attachment, compact_notebook,
+                                 compressed_name, decompress)
+from techela.download import Downloader
+from techela.jobs import JobQueue
+from techela.jupyter import open_notebook
+from techela.metrics import METRICS, init_app as init_metrics
+from techela.mirror import Mirror
+from techela.watcher import Watcher
 
-from flask import Flask, render_template, redirect, url_for, request
+app = Flask(__name__)
+init_metrics(app)
 
-__version__ = get_distribution('techela').version
+# These are set up by create_app for a course.
+COURSE = None
+COURSEDIR = None
+COURSEINFO_URL = None
+COURSEDATA = None
 
-app = Flask(__name__)
+BOX_EMAIL = None
+BASEURL = None
 
-# We need to get this information elsewhere
+LECTUREURL = None
+ASSIGNMENTURL = None
+SOLUTIONURL = None
 
-print(sys.argv, len(sys.argv))
-if (len(sys.argv) != 2):
-    raise Exception('Did you run "python -m techela.app <course-label>"')
+# This file contains user data, andrew id, name
+USERCONFIG = None
+
+GRADES = None
+COURSE_FILES = None
+ROSTER = None
+MAILER = None
+ARCHIVE = None
+WATCHER = None
+JOBS = None
+DOWNLOADER = None
+MIRROR = None
+
+
+@functools.lru_cache()
+def get_version():
+    "Return the installed version of techela."
+    from importlib.metadata import version
+    return version('techela')
+
+
+def __getattr__(name):
+    # Reading the package metadata is slow, so __version__ is computed when
+    # somebody asks for it.
+    if name == '__version__':
+        return get_version()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def create_app(course_label, offline=False, coursedir=None):
+    """Set up techela for COURSE_LABEL and return the flask app.
+    This gets the registered course info, unless OFFLINE is truthy in which
+    case the copy saved the last time is used. It also makes the course
+    directory if needed. COURSEDIR defaults to ~/COURSE_LABEL/.
+    """
+    global COURSE, COURSEDIR, COURSEINFO_URL, COURSEDATA
+    global BOX_EMAIL, BASEURL, LECTUREURL, ASSIGNMENTURL, SOLUTIONURL
+    global USERCONFIG, GRADES, COURSE_FILES, ROSTER, MAILER, ARCHIVE, WATCHER
+    global JOBS, _GRADEBOOK, DOWNLOADER, MIRROR
 
-# I assume you run the command like "python -m techela.app <course-label>" In
-# this case, -m is the first element of sys.argv, and the label is the second
-# one.
-COURSE = sys.argv[1]
-COURSEDIR = os.path.expanduser(f'~/{COURSE}/')
+    COURSE = course_label
+    # The rest of the code expects a trailing slash.
+    COURSEDIR = os.path.join(os.path.expanduser(coursedir or f'~/{COURSE}'),
+                             '')
 
-# First we have get the registered course info.
-COURSEINFO_URL = ('https://raw.githubusercontent.com/jkitchin/techela/'
-                  f'master/registered-courses/{COURSE}.json')
+    # First we have get the registered course info.
+    COURSEINFO_URL = ('https://raw.githubusercontent.com/jkitchin/techela/'
+                      f'master/registered-courses/{COURSE}.json')
 
-try:
-    local_filename, headers = urllib.request.urlretrieve(COURSEINFO_URL)
-    # We succeeded in getting it, and now it is in local_filename
     # Now we make sure the COURSEDIR exists, and make it otherwise
-    if not os.path.isdir(COURSEDIR):
-        os.makedirs(COURSEDIR)
-        os.makedirs(COURSEDIR + 'assignments/')
-        os.makedirs(COURSEDIR + 'solutions/')
-        os.makedirs(COURSEDIR + 'lectures/')
+    for d in ['assignments', 'solutions', 'lectures', 'graded-assignments']:
+        os.makedirs(COURSEDIR + d, exist_ok=True)
 
-    if not os.path.isdir(COURSEDIR + 'graded-assignments/'):
-        os.makedirs(COURSEDIR + 'graded-assignments/')
+    if DOWNLOADER:
+        DOWNLOADER.close()
+    DOWNLOADER = Downloader(os.path.join(COURSEDIR, 'download-cache'))
+    MIRROR = None
 
-    shutil.copyfile(local_filename, COURSEDIR + 'course-data.json')
+    # Without the network we start with the copy saved the last time.
+    course_data = COURSEDIR + 'course-data.json'
+    if not offline or not os.path.exists(course_data):
+        try:
+            download(COURSEINFO_URL, course_data)
+        except urllib.error.URLError as e:
+            if not os.path.exists(course_data):
+                raise Exception(f'Course info not found for {COURSE}: {e}')
+            print(f'Unable to get the course info, using the saved copy: {e}')
 
-    with open(COURSEDIR + f'course-data.json') as f:
+    with open(course_data, encoding='utf-8') as f:
         COURSEDATA = json.loads(f.read())
 
-except urllib.error.HTTPError:
-    print('Course info not found.')
-    sys.exit()
+    BOX_EMAIL = COURSEDATA['submit-email']
+    BASEURL = COURSEDATA['course-raw-url']
+
+    LECTUREURL = BASEURL + 'lectures/'
+    ASSIGNMENTURL = BASEURL + 'assignments/'
+    SOLUTIONURL = BASEURL + 'solutions/'
+
+    USERCONFIG = f'{COURSEDIR}/techela.json'
+    app.config['METRICS_HEADER'] = COURSEDATA.get('timing-header', False)
+
+    GRADES = GradeIndex(os.path.join(COURSEDIR, 'grade-index.sqlite'))
+    MIRROR = Mirror(BASEURL, DOWNLOADER,
+                    os.path.join(COURSEDIR, 'mirror.json'))
+    COURSE_FILES = CourseFiles(f'{BASEURL}/course-files.json',
+                               f'{COURSEDIR}/course-files.json', DOWNLOADER,
+                               on_refresh=start_mirror_sync)
+    ROSTER = Roster(os.path.expanduser(f'{COURSEDATA["local-box-path"]}/roster.csv'))  # NOQA
+    MAILER = None
+    ARCHIVE = ArchiveStore(os.path.expanduser(f"{COURSEDATA['local-box-path']}/assignments-archive"))  # NOQA
+    if WATCHER:
+        WATCHER.stop()
+    WATCHER = None
+    JOBS = JobQueue(COURSEDATA.get('job-workers', 2))
+    _GRADEBOOK = None
+    return app
+
+
+def download(url, fname):
+    """Download URL to FNAME.
+    Course files whose hash in course-files.json matches the one in the
+    mirror are copied from it without the network. Anything else goes through
+    the download cache, so an unchanged file is not transferred again, and
+    when the server cannot be reached we use the copy we have, if any. FNAME
+    is never partial. Returns a Download.
+    """
+    path = MIRROR.path(url) if MIRROR else None
+    if path and COURSE_FILES and COURSE_FILES.data:
+        if MIRROR.current(path, COURSE_FILES.data.get('hashes', {})):
+            return DOWNLOADER.copy(url, fname)
+    try:
+        return DOWNLOADER.get(url, fname)
+    except urllib.error.HTTPError:
+        raise
+    except urllib.error.URLError as e:
+        result = DOWNLOADER.copy(url, fname)
+        if result is None:
+            raise
+        print(f'Unable to download {url}, using the saved copy: {e}')
+        return result
+
+
+def sync_mirror(progress=None):
+    """Bring the mirror up to date with the hashes in course-files.json.
+    Returns the PROGRESS dictionary, or None if there are no hashes."""
+    hashes = COURSE_FILES.get().get('hashes', None)
+    if not hashes:
+        return None
+    return MIRROR.sync(hashes, COURSEDATA.get('prefetch-workers', 8),
+                       progress)
+
+
+def start_mirror_sync(data):
+    """Start syncing the mirror in a job if it is out of date with DATA, the
+    course files. Files that did not match their hash the last time are not
+    a reason to sync again until their hash changes."""
+    if MIRROR.pending(data.get('hashes', None) or {}):
+        JOBS.submit('mirror', None,
+                    lambda job: sync_mirror(job.progress) and None)
+
+
+def mail_attachment(content, filename):
+    """Return an email attachment of the notebook bytes CONTENT.
+    Notebooks bigger than attachment-max-size bytes in the course data have
+    their largest outputs removed, and attachment-compression (gzip or zip)
+    compresses it. Both are off by default.
+    """
+    content = compact_notebook(content,
+                               COURSEDATA.get('attachment-max-size', None))
+    return attachment(content, filename,
+                      COURSEDATA.get('attachment-compression', None))
 
-BOX_EMAIL = COURSEDATA['submit-email']
-BASEURL = COURSEDATA['course-raw-url']
 
-LECTUREURL = BASEURL + 'lectures/'
-ASSIGNMENTURL = BASEURL + 'assignments/'
-SOLUTIONURL = BASEURL + 'solutions/'
+_MAILER_LOCK = threading.Lock()
+
+
+def get_mailer():
+    """Return the Mailer used to return assignments.
+    The relay and rate limit can be set in the course data with the keys
+    smtp-relay, smtp-port, smtp-ssl, smtp-connections and smtp-rate (messages
+    per second).
+    """
+    global MAILER
+    # The return pool asks for it from many threads at once, and there must
+    # only be one, or the rate limit and connection cap do not hold.
+    with _MAILER_LOCK:
+        if MAILER is None:
+            from techela.mail import Mailer
+            MAILER = Mailer(COURSEDATA.get('smtp-relay',
+                                           'relay.andrew.cmu.edu'),
+                            port=COURSEDATA.get('smtp-port', 465),
+                            ssl=COURSEDATA.get('smtp-ssl', True),
+                            size=COURSEDATA.get('smtp-connections', 1),
+                            rate=COURSEDATA.get('smtp-rate', 1.0))
+        return MAILER
+
+# * Notebook metadata
+
+# The grading routes only need a few fields from the top-level metadata of a
+# notebook, but the notebooks can be many MB of base64 encoded plots. Jupyter
+# (and techela) write the top-level keys in the order cells, metadata, nbformat,
+# nbformat_minor, so the metadata is at the end of the file, and we can usually
+# read it from the tail without parsing the cells at all.
+
+NotebookMetadata = namedtuple('NotebookMetadata',
+                              ['graded',
+                               'overall',
+                               'technical',
+                               'presentation',
+                               'turned_in',
+                               'returned',
+                               'grader',
+                               'metadata'])
+
+_METADATA_KEY = re.compile(r'"metadata"\s*:\s*')
+# What may follow the top-level metadata object to the end of the file.
+_NOTEBOOK_TAIL = re.compile(r'\s*(,\s*"nbformat(_minor)?"\s*:\s*\d+\s*)*}\s*$')
+_DECODER = json.JSONDecoder()
+
+
+def _find_metadata(text):
+    """Find the top-level metadata object in the notebook TEXT.
+    TEXT may be the tail of a notebook. Returns (start, end, metadata) where
+    start and end delimit the metadata object in TEXT, or None if it is not
+    found.
+    """
+    for m in reversed(list(_METADATA_KEY.finditer(text))):
+        try:
+            metadata, end = _DECODER.raw_decode(text, m.end())
+        except ValueError:
+            continue
+        if isinstance(metadata, dict) and _NOTEBOOK_TAIL.match(text, end):
+            return m.end(), end, metadata
+    return None
+
+
+def notebook_metadata(metadata):
+    """Return a NotebookMetadata record for the METADATA dictionary."""
+    grade = metadata.get('grade', None) or {}
+    turned_in = metadata.get('TURNED-IN', None)
+    return NotebookMetadata(graded=bool(grade),
+                            overall=grade.get('overall', None),
+                            technical=grade.get('technical', None),
+                            presentation=grade.get('presentation', None),
+                            turned_in=(turned_in['timestamp']
+                                       if turned_in else None),
+                            returned=metadata.get('RETURNED', None) or None,
+                            grader=(metadata.get('org', None)
+                                    or {}).get('GRADER', None),
+                            metadata=metadata)
+
+
+def read_notebook_metadata(fname, tail=2**16):
+    """Return a NotebookMetadata record for the notebook FNAME.
+    Only the end of the file is read and parsed when possible. We fall back to
+    parsing the whole file if the metadata is not where we expect it.
+    """
+    METRICS.count('notebooks_opened')
+    with open(fname, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        while True:
+            start = max(0, size - tail)
+            f.seek(start)
+            text = f.read().decode('utf-8', errors='replace')
+            METRICS.count('notebook_bytes', size - start)
+            with METRICS.timer('json_decode_seconds'):
+                found = _find_metadata(text)
+            if found or start == 0:
+                break
+            tail *= 16
+
+    if found:
+        metadata = found[2]
+    else:
+        with METRICS.timer('json_decode_seconds'):
+            metadata = json.loads(text)['metadata']
+    return notebook_metadata(metadata)
+
+
+def parse_notebook(content):
+    "Parse the notebook bytes CONTENT."
+    METRICS.count('notebooks_opened')
+    METRICS.count('notebook_bytes', len(content))
+    with METRICS.timer('json_decode_seconds'):
+        return json.loads(content.decode('utf-8'))
+
+
+def read_notebook(fname):
+    "Read and parse the whole notebook FNAME."
+    with open(fname, 'rb') as f:
+        return parse_notebook(f.read())
+
+
+# ** Changing the metadata
+
+# Stamping a notebook as turned in or returned only changes the top-level
+# metadata, so we find it in the tail of the file like read_notebook_metadata
+# does, and replace just those bytes. The cells are kept as they are, and the
+# new file replaces the old one in one step (write_atomic) so a crash cannot
+# leave a half written notebook.
+
+
+def _metadata_span(f, tail=2**16):
+    """Find the top-level metadata in the open notebook file F.
+    Returns (start, end, text, metadata), where start and end are the byte
+    offsets of the metadata object in F and text is its json, or None.
+    """
+    size = f.seek(0, os.SEEK_END)
+    while True:
+        start = max(0, size - tail)
+        f.seek(start)
+        # surrogateescape keeps a character cut by the seek (or any bad utf-8)
+        # as the same bytes when we encode again, so the offsets are exact.
+        text = f.read().decode('utf-8', errors='surrogateescape')
+        found = _find_metadata(text)
+        if found:
+            i, j, metadata = found
+            return (start + len(text[:i].encode('utf-8', 'surrogateescape')),
+                    start + len(text[:j].encode('utf-8', 'surrogateescape')),
+                    text[i:j], metadata)
+        if start == 0:
+            return None
+        tail *= 16
+
+
+def _dump_metadata(metadata, original):
+    """Return the json of METADATA formatted like ORIGINAL, the json it
+    replaces. Notebooks saved by Jupyter are indented, and the ones techela
+    writes are not."""
+    first = re.match(r'{\n( *)', original)
+    last = re.search(r'\n( *)}$', original)
+    if not (first and last) or len(first.group(1)) <= len(last.group(1)):
+        return json.dumps(metadata)
+    indent = len(first.group(1)) - len(last.group(1))
+    text = json.dumps(metadata, indent=indent, ensure_ascii=False)
+    return text.replace('\n', '\n' + last.group(1))
+
+
+def patch_notebook_metadata(content, update):
+    """Return the notebook bytes CONTENT with its top-level metadata changed.
+    UPDATE is called with the metadata dictionary, and changes it in place.
+    Everything but the metadata is kept byte for byte.
+    """
+    import io
+    span = _metadata_span(io.BytesIO(content))
+    if span is None:
+        j = parse_notebook(content)
+        update(j['metadata'])
+        return json.dumps(j).encode('utf-8')
+    start, end, text, metadata = span
+    update(metadata)
+    return (content[:start]
+            + _dump_metadata(metadata, text).encode('utf-8')
+            + content[end:])
+
+
+class GradeIndex:
+    """An on-disk index of the grade metadata in graded notebooks.
+    Rows are keyed by (andrewid, label) and store a fingerprint (mtime and size)
+    of the file they were read from, so a notebook is only read again when it
+    changes. The index is just a cache; it is safe to delete the file.
+    """
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(dbfile, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=OFF')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS grades
+                           (andrewid TEXT, label TEXT, path TEXT,
+                            mtime INTEGER, size INTEGER, graded INTEGER,
+                            overall, technical, presentation,
+                            turned_in TEXT, returned TEXT, grader TEXT,
+                            PRIMARY KEY (andrewid, label))''')
+        self.db.commit()
+
+    def get(self, andrewid, label, fname):
+        """Return a NotebookMetadata record for FNAME, or None if it does not
+        exist. The metadata field of records served from the index is None.
+        """
+        try:
+            st = os.stat(fname)
+        except FileNotFoundError:
+            with self.lock:
+                self.db.execute('DELETE FROM grades WHERE andrewid=? AND label=?',
+                                (andrewid, label))
+                self.db.commit()
+            return None
+
+        with self.lock:
+            row = self.db.execute('''SELECT path, mtime, size, graded, overall,
+                                     technical, presentation, turned_in,
+                                     returned, grader FROM grades
+                                     WHERE andrewid=? AND label=?''',
+                                  (andrewid, label)).fetchone()
+
+        if row and row[:3] == (fname, st.st_mtime_ns, st.st_size):
+            return NotebookMetadata(bool(row[3]), *row[4:], metadata=None)
+
+        md = read_notebook_metadata(fname)
+        with self.lock:
+            self.db.execute('''INSERT OR REPLACE INTO grades
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                            (andrewid, label, fname,
+                             st.st_mtime_ns, st.st_size, int(md.graded),
+                             md.overall, md.technical, md.presentation,
+                             md.turned_in, md.returned, md.grader))
+            self.db.commit()
+        return md
+
+
+# * Course files
+
+
+DAY = 24 * 60 * 60
+
+
+class Assignment:
+    """An assignment in course-files.json.
+    The due date is parsed once. DUE is it as a UTC timestamp, or None if the
+    assignment has no due date, and the urgency boundaries are precomputed so
+    `postdue' and `urgency' are just comparisons with the time.
+    """
+
+    __slots__ = ('label', 'path', 'duedate', 'due', 'category', 'points',
+                 'grader', 'rubric', '_soon', '_week')
+
+    def __init__(self, path, entry):
+        self.path = path
+        self.label = entry.get('label') or os.path.splitext(
+            os.path.split(path)[-1])[0]
+        self.duedate = entry.get('duedate')
+        self.category = entry.get('category')
+        self.points = entry.get('points')
+        self.grader = entry.get('grader')
+        self.rubric = entry.get('rubric', 'default')
+        if self.duedate:
+            # due dates are in UTC
+            self.due = calendar.timegm(datetime.strptime(
+                self.duedate, "%Y-%m-%d %H:%M:%S").timetuple())
+            # less than 3 and 8 days before it is due
+            self._soon = self.due - 3 * DAY
+            self._week = self.due - 8 * DAY
+        else:
+            self.due = self._soon = self._week = None
+
+    def postdue(self, now=None):
+        "Return True if the assignment is due at NOW (a timestamp)."
+        if self.due is None:
+            return False
+        return (time.time() if now is None else now) >= self.due
+
+    def urgency(self, now=None):
+        """Return how soon the assignment is due at NOW (a timestamp).
+        That is 'past', 'soon' (in 2 days or less), 'week' (in 7 days or less)
+        or 'later'."""
+        if self.due is None:
+            return 'later'
+        now = time.time() if now is None else now
+        if now >= self.due:
+            return 'past'
+        elif now >= self._soon:
+            return 'soon'
+        elif now >= self._week:
+            return 'week'
+        return 'later'
+
+
+class Course:
+    """The assignments in the course-files.json DATA.
+    They are kept in course-files.json order and indexed by label. Use
+    `CourseFiles.get_course' to get the one for the current course files.
+    """
+
+    def __init__(self, data):
+        self.assignments = [Assignment(path, entry) for path, entry
+                            in data.get('assignments', {}).items()]
+        self.labels = {a.label: a for a in self.assignments}
+
+    def __iter__(self):
+        return iter(self.assignments)
+
+    def __len__(self):
+        return len(self.assignments)
+
+    def get(self, label):
+        "Return the Assignment LABEL, or None if there is no such assignment."
+        return self.labels.get(label)
+
+    def postdue(self, now=None):
+        "Return the assignments that are due at NOW (a timestamp)."
+        now = time.time() if now is None else now
+        return [a for a in self.assignments if a.postdue(now)]
+
+
+class CourseFiles:
+    """The course-files.json manifest of a course.
+    `get' returns the last good copy right away. Refreshing it from URL happens
+    on a background thread with a conditional request through DOWNLOADER, and
+    the new copy is saved in FNAME. ON_REFRESH is called with the data after
+    each refresh that reached the server. The parsed data, and the Course
+    made from it, are shared by all routes, so treat them as read-only.
+    """
+
+    def __init__(self, url, fname, downloader, min_interval=10,
+                 on_refresh=None):
+        self.url = url
+        self.fname = fname
+        self.downloader = downloader
+        self.min_interval = min_interval
+        self.on_refresh = on_refresh
+        self.data = None
+        self.course = None
+        self.online = True
+        self.checked = 0
+        self.version = 0
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        "Load the local copy, if there is one."
+        if os.path.exists(self.fname):
+            with open(self.fname, encoding='utf-8') as f:
+                self.data = json.loads(f.read())
+            self.course = Course(self.data)
+            self.version += 1
+
+    def refresh(self):
+        """Download the manifest if it changed since the last download.
+        Sets the online attribute to whether the server could be reached."""
+        try:
+            result = self.downloader.get(self.url)
+            if result.changed or self.data is None:
+                with open(result.path, 'rb') as f:
+                    content = f.read()
+                data = json.loads(content.decode('utf-8'))
+                course = Course(data)
+                write_atomic(self.fname, content)
+                with self.lock:
+                    self.data = data
+                    self.course = course
+                    self.version += 1
+            self.online = True
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            print(f'Unable to download {self.url}: {e}')
+            self.online = False
+            return
+        finally:
+            self.checked = time.time()
+
+        if self.on_refresh:
+            # Problems here are not problems with the download.
+            try:
+                self.on_refresh(self.data)
+            except Exception:
+                traceback.print_exc()
+
+    def get(self, refresh=False):
+        """Return the parsed manifest.
+        If REFRESH is truthy start a background refresh, unless one is running
+        or happened in the last min_interval seconds. We only wait on the
+        network when there is no local copy at all.
+        """
+        with self.lock:
+            if self.data is None:
+                self.load()
+            start = (refresh
+                     and time.time() - self.checked > self.min_interval
+                     and not (self.thread and self.thread.is_alive()))
+            if start:
+                self.thread = threading.Thread(target=self.refresh,
+                                               daemon=True)
+                self.thread.start()
+
+        if self.data is None:
+            if self.thread and self.thread.is_alive():
+                self.thread.join()
+            else:
+                self.refresh()
+        return self.data
+
+    def get_course(self, refresh=False):
+        "Return the Course of the manifest. REFRESH is like in `get'."
+        self.get(refresh)
+        return self.course
 
-# This file contains user data, andrew id, name
-USERCONFIG = f'{COURSEDIR}/techela.json'
 
 # The flask app
 
@@ -87,6 +638,7 @@ def open_course(path=None):
         os.startfile(d)
     else:
         opener = "open" if sys.platform == "darwin" else "xdg-open"
+        METRICS.count('subprocesses')
         subprocess.call([opener, d])
 
     return redirect(url_for('hello'))
@@ -104,18 +656,9 @@ def hello():
         ANDREWID = data['ANDREWID']
         NAME = data['NAME']
 
-    # Should be setup now. Update the course info
-    ONLINE = True
-    try:
-        urllib.request.urlretrieve(f'{BASEURL}/course-files.json',
-                                   f'{COURSEDIR}/course-files.json')
-    except urllib.error.HTTPError:
-        print(f'{BASEURL}/blob/master/course-files.json')
-        print('Unable to download the course json file!!!!!!')
-        ONLINE = False
-
-    with open(f'{COURSEDIR}/course-files.json', encoding='utf-8') as f:
-        data = json.loads(f.read())
+    # Should be setup now. Update the course info in the background.
+    data = COURSE_FILES.get(refresh=True)
+    ONLINE = COURSE_FILES.online
 
     # First get lecture status
     lecture_paths = [os.path.join(COURSEDIR, path)
@@ -133,11 +676,9 @@ def hello():
     # Next get assignments. These are in assignments/label.ipynb For students I
     # construct assignments/andrewid-label.ipynb to check if they have local
     # versions.
-    assignments = data['assignments']
+    course = COURSE_FILES.get_course()
 
-    assignment_files = [os.path.split(assignment)[-1]
-                        for assignment in assignments]
-    assignment_labels = [os.path.splitext(f)[0] for f in assignment_files]
+    assignment_labels = [a.label for a in course]
     assignment_paths = ['{}assignments/{}-{}.ipynb'.format(COURSEDIR,
                                                            ANDREWID,
                                                            label)
@@ -146,31 +687,17 @@ def hello():
                          else '<font color="red">Not downloaded</font>'
                          for path in assignment_paths]
 
-    duedates = [assignments[f]['duedate'] for f in assignments]
-    colors = []
-    for dd in duedates:
-        today = datetime.utcnow()
-        d = datetime.strptime(dd, "%Y-%m-%d %H:%M:%S")
-
-        if (d - today).days < 0:
-            colors.append('black')
-        elif (d - today).days <= 2:
-            colors.append('red')
-        elif (d - today).days <= 7:
-            colors.append('orange')
-        else:
-            colors.append('green')
+    duedates = [a.duedate for a in course]
+    now = time.time()
+    urgency_colors = {'past': 'black', 'soon': 'red', 'week': 'orange',
+                      'later': 'green'}
+    colors = [urgency_colors[a.urgency(now)] for a in course]
 
     turned_in = []
     for path in assignment_paths:
         if os.path.exists(path):
-            with open(path, encoding='utf-8') as f:
-                d = json.loads(f.read())
-                ti = d['metadata'].get('TURNED-IN', None)
-                if ti:
-                    turned_in.append(ti['timestamp'])
-                else:
-                    turned_in.append('Not yet.')
+            ti = read_notebook_metadata(path).turned_in
+            turned_in.append(ti or 'Not yet.')
         else:
             turned_in.append(None)
 
@@ -184,15 +711,10 @@ def hello():
     # graded assignments
     graded_assignments = []
     for ipynb in glob.glob(COURSEDIR + 'graded-assignments/*.ipynb'):
-        with open(ipynb, encoding='utf-8') as f:
-            gd = json.loads(f.read())
-
-            graded_assignments += [[os.path.split(ipynb)[-1],
-                                    gd['metadata'].get('grade',
-                                                       {}).get('overall',
-                                                               None),
-                                    gd['metadata']['org'].get('GRADER',
-                                                              'unknown')]]
+        gd = read_notebook_metadata(ipynb)
+        graded_assignments += [[os.path.split(ipynb)[-1],
+                                gd.overall,
+                                gd.grader or 'unknown']]
 
     return render_template('hello.html',
                            COURSEDATA=COURSEDATA,
@@ -200,8 +722,9 @@ def hello():
                            ANDREWID=ANDREWID,
                            NAME=NAME,
                            ONLINE=ONLINE,
+                           prefetch=JOBS.latest('prefetch', None),
                            announcements=data['announcements'],
-                           version=__version__,
+                           version=get_version(),
                            lectures=list(zip(lecture_labels,
                                              lecture_status,
                                              lecture_keywords)),
@@ -259,20 +782,150 @@ def setup_post():
     return redirect(url_for('hello'))
 
 
+# * Downloading course files
+
+# Lectures refer to images like this in the cells:
+# ![img](./images/control-volume.png), so we download those with the notebook.
+_IMAGE_REFS = re.compile(r'!\[[^\]]*\]\(\s*<?([^)\s>]+)'
+                         r'|<img[^>]*\ssrc\s*=\s*["\']([^"\']+)["\']')
+
+
+def notebook_images(url, fname, image_dir=None, force=False):
+    """Return (url, path) for the images referenced in the notebook FNAME.
+    URL is where the notebook came from, and the images are relative to it.
+    Paths are relative to IMAGE_DIR, the directory of FNAME by default. Images
+    we already have are left out unless FORCE is truthy, and so are references
+    that would end up outside of IMAGE_DIR.
+    """
+    image_dir = os.path.abspath(image_dir or os.path.dirname(fname))
+    images = {}
+    for cell in read_notebook(fname).get('cells', []):
+        if cell.get('cell_type') != 'markdown':
+            continue
+        source = cell.get('source', '')
+        if isinstance(source, list):
+            source = ''.join(source)
+        for m in _IMAGE_REFS.finditer(source):
+            ref = urllib.parse.unquote(m.group(1) or m.group(2))
+            parsed = urllib.parse.urlparse(ref)
+            if parsed.scheme or parsed.netloc or ref.startswith('/'):
+                continue
+            path = os.path.normpath(os.path.join(image_dir, parsed.path))
+            if os.path.commonpath([path, image_dir]) != image_dir:
+                continue
+            if force or not os.path.exists(path):
+                images[path] = urllib.parse.urljoin(url, parsed.path)
+    return [(image_url, path) for path, image_url in images.items()]
+
+
+def download_notebook(url, fname, image_dir=None, force=False):
+    """Download the notebook at URL to FNAME, with the images it references.
+    The notebook is downloaded if FNAME does not exist or FORCE is truthy, and
+    the images if we do not have them. See `notebook_images' for IMAGE_DIR.
+    Images that fail to download are reported, but do not stop the notebook
+    from being used.
+    """
+    if force or not os.path.exists(fname):
+        download(url, fname)
+    for image_url, path in notebook_images(url, fname, image_dir):
+        try:
+            download(image_url, path)
+        except (urllib.error.URLError, OSError) as e:
+            print(f'Unable to download {image_url}: {e}')
+
+
+def assignment_template(label):
+    "Return the path to the downloaded template of assignment LABEL."
+    return os.path.join(COURSEDIR, 'assignment-templates', f'{label}.ipynb')
+
+
+def prefetch_course(force=False, progress=None):
+    """Download the lectures, assignments and solutions in course-files.json
+    and the images they reference, in a pool of threads.
+    Files we already have are skipped unless FORCE is truthy. PROGRESS is an
+    optional dictionary that is updated as the files are downloaded.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    # With hashes in the course files, the mirror gets everything that changed
+    # and the copies below come from it.
+    sync_mirror()
+
+    data = COURSE_FILES.get()
+    # (url, local path, image directory)
+    notebooks = [(BASEURL + path, COURSEDIR + path, None)
+                 for path in data['lectures'] + data['solutions']]
+    notebooks += [(BASEURL + path,
+                   assignment_template(os.path.splitext(os.path.basename(path))[0]),  # NOQA
+                   COURSEDIR + 'assignments')
+                  for path in data['assignments']]
+
+    if progress is None:
+        progress = {}
+    progress.update(total=len(notebooks), done=0, downloaded=0, failed=0,
+                    errors=[])
+
+    # These return (downloaded, images)
+    def get_notebook(url, fname, image_dir):
+        downloaded = force or not os.path.exists(fname)
+        if downloaded:
+            download(url, fname)
+        return downloaded, notebook_images(url, fname, image_dir, force)
+
+    def get_image(url, fname):
+        download(url, fname)
+        return True, []
+
+    with ThreadPoolExecutor(COURSEDATA.get('prefetch-workers', 8)) as pool:
+        # The images are found once their notebooks are here.
+        futures = {pool.submit(contextvars.copy_context().run,
+                               get_notebook, *task): task[0]
+                   for task in notebooks}
+        while futures:
+            # path: url, so images shared by notebooks are downloaded once
+            images = {}
+            for future in as_completed(futures):
+                try:
+                    downloaded, found = future.result()
+                    progress['downloaded'] += downloaded
+                    images.update((path, url) for url, path in found)
+                except (urllib.error.URLError, OSError, ValueError) as e:
+                    progress['failed'] += 1
+                    progress['errors'] += [f'{futures[future]}: {e}']
+                progress['done'] += 1
+            progress['total'] += len(images)
+            futures = {pool.submit(contextvars.copy_context().run,
+                                   get_image, url, fname): url
+                       for fname, url in images.items()}
+    return progress
+
+
+@app.route('/prefetch')
+def prefetch():
+    """Download all the course files in a background job.
+    With a force parameter, files we already have are downloaded again. The
+    main page shows how it is going."""
+    force = bool(request.args.get('force'))
+    JOBS.submit('prefetch', None,
+                lambda job: prefetch_course(force, job.progress) and None)
+    return redirect(url_for('hello'))
+
+
+@app.route('/mirror')
+def mirror():
+    "Sync the course mirror in a background job."
+    job = JOBS.submit('mirror', None,
+                      lambda job: sync_mirror(job.progress) and None)
+    return redirect(url_for('job_status', id=job.id))
+
+
 @app.route("/lecture/<label>")
 def open_lecture(label):
     fname = '{}/lectures/{}.ipynb'.format(COURSEDIR, label)
-    if not os.path.exists(fname):
-        urllib.request.urlretrieve(LECTUREURL
-                                   + '{}.ipynb'.format(label), fname)
-        # We need to check for images. Boo...
-        # They look like this in the cells: ![img](./images/control-volume.png)
+    download_notebook(LECTUREURL + '{}.ipynb'.format(label), fname)
 
     # Now open the notebook.
-    cmd = ["jupyter", "notebook", fname]
-    subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                     stderr=subprocess.PIPE,
-                     stdin=subprocess.PIPE)
+    open_notebook(fname, COURSEDIR)
 
     return redirect(url_for('hello'))
 
@@ -281,17 +934,10 @@ def open_lecture(label):
 def open_course_lecture(label):
     fname = f'{COURSEDIR}/lectures/course-{label}.ipynb'
 
-    if os.path.exists(fname):
-        os.unlink(fname)
-    urllib.request.urlretrieve(LECTUREURL
-                               + f'{label}.ipynb',
-                               fname)
+    download_notebook(LECTUREURL + f'{label}.ipynb', fname, force=True)
 
     # Now open the notebook.
-    cmd = ["jupyter", "notebook", fname]
-    subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                     stderr=subprocess.PIPE,
-                     stdin=subprocess.PIPE)
+    open_notebook(fname, COURSEDIR)
 
     return redirect(url_for('hello'))
 
@@ -300,14 +946,16 @@ def open_course_lecture(label):
 def open_solution(label):
     fname = f'{COURSEDIR}/solutions/{label}.ipynb'
 
-    urllib.request.urlretrieve(SOLUTIONURL
-                               + f'{label}.ipynb', fname)
+    # Solutions can be updated, so we get the latest, unless we are offline
+    # and have a copy.
+    try:
+        download_notebook(SOLUTIONURL + f'{label}.ipynb', fname, force=True)
+    except (urllib.error.URLError, OSError):
+        if not os.path.exists(fname):
+            raise
 
     # Now open the notebook.
-    cmd = ["jupyter", "notebook", fname]
-    subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                     stderr=subprocess.PIPE,
-                     stdin=subprocess.PIPE)
+    open_notebook(fname, COURSEDIR)
 
     return redirect(url_for('hello'))
 
@@ -318,10 +966,7 @@ def admin_solution(label):
     fname = os.path.expanduser(f"{COURSEDATA['local-box-path']}/solutions/{label}.ipynb")
 
     # Now open the notebook.
-    cmd = ["jupyter", "notebook", fname]
-    subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                     stderr=subprocess.PIPE,
-                     stdin=subprocess.PIPE)
+    open_notebook(fname, os.path.expanduser(COURSEDATA['local-box-path']))
 
     return redirect(url_for('admin'))
 
@@ -335,12 +980,15 @@ def open_assignment(label):
 
     fname = f'{COURSEDIR}assignments/{ANDREWID}-{label}.ipynb'
     if not os.path.exists(fname):
-        urllib.request.urlretrieve(f'{ASSIGNMENTURL}/{label}.ipynb',
-                                   fname)
+        template = assignment_template(label)
+        # The assignment may have been fixed since it was prefetched. This
+        # only costs a 304 when it was not.
+        download_notebook(f'{ASSIGNMENTURL}{label}.ipynb', template,
+                          f'{COURSEDIR}assignments', force=True)
+        shutil.copyfile(template, fname)
 
         # Insert their full name at the top
-        with open(fname, encoding='utf-8') as f:
-            j = json.loads(f.read())
+        j = read_notebook(fname)
 
         dt = datetime.now()
 
@@ -355,15 +1003,10 @@ def open_assignment(label):
         j['metadata']['author']['name'] = NAME
         j['metadata']['author']['email'] = f'{ANDREWID}@andrew.cmu.edu'
 
-        with open(fname, 'w', encoding='utf-8') as f:
-            f.write(json.dumps(j))
+        write_atomic(fname, json.dumps(j).encode('utf-8'))
 
     # Now open the notebook.
-    # os.system('jupyter notebook {}'.format(fname))
-    cmd = ["jupyter", "notebook", fname]
-    subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                     stderr=subprocess.PIPE,
-                     stdin=subprocess.PIPE)
+    open_notebook(fname, COURSEDIR)
 
     return redirect(url_for('hello'))
 
@@ -375,23 +1018,14 @@ def open_graded_assignment(fname):
 
     fname = COURSEDIR + f'graded-assignments/{fname}'
 
-    cmd = ["jupyter", "notebook", fname]
-    subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                     stderr=subprocess.PIPE,
-                     stdin=subprocess.PIPE)
+    open_notebook(fname, COURSEDIR)
 
     return redirect(url_for('hello'))
 
 
 @app.route("/new")
 def new_notebook():
-    CWD = os.getcwd()
-    os.chdir(COURSEDIR)
-    cmd = ["jupyter", "notebook"]
-    subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                     stderr=subprocess.PIPE,
-                     stdin=subprocess.PIPE)
-    os.chdir(CWD)
+    open_notebook(None, COURSEDIR)
     return redirect(url_for('hello'))
 
 
@@ -421,51 +1055,33 @@ def submit_post():
     msg['To'] = BOX_EMAIL
     msg['Cc'] = f'{ANDREWID}@andrew.cmu.edu'
 
-    ctype = 'application/octet-stream'
-    maintype, subtype = ctype.split('/', 1)
-
     fname = f'{COURSEDIR}/assignments/{ANDREWID}-{label}.ipynb'
     if not os.path.exists(fname):
         raise Exception(f'{fname} not found.')
 
-    # Save some turn in data.
-    with open(fname, encoding='utf-8') as f:
-        j = json.loads(f.read())
-
-    j['metadata']['TURNED-IN'] = {}
+    # Save some turn in data. The stamped notebook is made in memory, and only
+    # saved once it is sent.
     dt = datetime.now()
-    j['metadata']['TURNED-IN']['timestamp'] = dt.isoformat(" ")
-
-    with open(fname, 'w', encoding='utf-8') as f:
-        f.write(json.dumps(j))
-
-    with open(fname, 'rb') as fp:
-        attachment = MIMEBase(maintype, subtype)
-        attachment.set_payload(fp.read())
-        # Encode the payload using Base64
-        encoders.encode_base64(attachment)
-        # Set the filename parameter
-        aname = f'{ANDREWID}-{label}.ipynb'
-        attachment.add_header('Content-Disposition', 'attachment',
-                              filename=aname)
-        msg.attach(attachment)
+    with open(fname, 'rb') as f:
+        content = patch_notebook_metadata(
+            f.read(),
+            lambda md: md.update({'TURNED-IN': {'timestamp': dt.isoformat(" ")}}))  # NOQA
+
+    msg.attach(mail_attachment(content, f'{ANDREWID}-{label}.ipynb'))
 
     with smtplib.SMTP_SSL('smtp.andrew.cmu.edu', port=465) as s:
         try:
             s.login(ANDREWID, password)
         except smtplib.SMTPAuthenticationError:
             print('caught error for', label)
-            # Remove turned in
-            with open(fname, encoding='utf-8') as f:
-                j = json.loads(f.read())
-            del j['metadata']['TURNED-IN']
-            with open(fname, 'w', encoding='utf-8') as f:
-                f.write(json.dumps(j))
             return render_template("password_error.html", label=label)
 
         s.send_message(msg)
+        METRICS.count('smtp_sends')
         s.quit()
 
+    write_atomic(fname, content)
+
     return redirect(url_for('hello'))
 
 # * Admin
@@ -484,39 +1100,30 @@ def admin():
     cm = ConfigManager()
     cm.update('notebook', {"load_extensions": {"techela": True}})
 
-    ONLINE = True
-    try:
-        urllib.request.urlretrieve(f'{BASEURL}/course-files.json',
-                                   f'{COURSEDIR}/course-files.json')
-    except urllib.error.HTTPError:
-        print('Unable to download the course json file!!!!!!')
-        ONLINE = False
+    # Collect new submissions as they come in.
+    start_watcher()
 
     with open(USERCONFIG, encoding='utf-8') as f:
         data = json.loads(f.read())
         ANDREWID = data['ANDREWID']
         NAME = data['NAME']
 
-    with open(f'{COURSEDIR}/course-files.json', encoding='utf-8') as f:
-        data = json.loads(f.read())
+    course = COURSE_FILES.get_course(refresh=True)
+    ONLINE = COURSE_FILES.online
 
     # Next get assignments. These are in assignments/label.ipynb For students I
     # construct assignments/andrewid-label.ipynb to check if they have local
     # versions.
-    assignments = data['assignments']
-
-    assignment_files = [os.path.split(assignment)[-1]
-                        for assignment in assignments]
-    assignment_labels = [os.path.splitext(f)[0] for f in assignment_files]
+    assignment_labels = [a.label for a in course]
     # this is where solutions should be
     p1 = os.path.expanduser(f"{COURSEDATA['local-box-path']}/solutions/")
     solutions = [os.path.join(p1,
                               f'{label}.ipynb')
                  for label in assignment_labels]
 
-    duedates = [assignments[f]['duedate'] for f in assignments]
+    duedates = [a.duedate for a in course]
 
-    graders = [assignments[f]['grader'] for f in assignments]
+    graders = [a.grader for a in course]
 
     statuses = []
     for label in assignment_labels:
@@ -531,14 +1138,11 @@ def admin():
             statuses.append(None)
 
     colors = []
-    for status, dd in zip(statuses, duedates):
-        today = datetime.utcnow()
-
-        d = datetime.strptime(dd, "%Y-%m-%d %H:%M:%S")
-
+    now = time.time()
+    for status, a in zip(statuses, course):
         if status is not None and status.startswith('Returned'):
             colors.append('black')
-        elif (d - today).days <= 2:
+        elif a.urgency(now) in ('past', 'soon'):
             colors.append('orange')
         else:
             colors.append('red')
@@ -559,18 +1163,46 @@ def admin():
                                                           solutions)))
 
 
+class Roster:
+    """The students in roster.csv.
+    The file is parsed once, and again only when its mtime changes. Entries
+    are kept in file order, and indexed by Andrew ID.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.mtime = None
+        self.entries = []
+        self.by_id = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        "Parse the roster file again if it changed. Returns the roster."
+        import csv
+        mtime = os.stat(self.fname).st_mtime_ns
+        with self.lock:
+            if mtime != self.mtime:
+                with open(self.fname, encoding='utf-8') as f:
+                    reader = csv.reader(f, delimiter=',')
+                    rows = [row for row in reader]
+                # skip first entry that is the headers
+                self.entries = [dict(zip(rows[0], row)) for row in rows[1:]]
+                self.by_id = {d['Andrew ID']: d for d in self.entries}
+                self.mtime = mtime
+        return self
+
+    def get(self, andrewid):
+        "Return the roster entry for ANDREWID or None."
+        return self.refresh().by_id.get(andrewid, None)
+
+
+
 def get_roster():
     """Read roster and return a list of dictionaries for each student.
 The roster.csv file is just the file downloaded from s3, renamed to roster.csv.
+The list is a copy, so it is fine to shuffle it.
     """
-    import csv
-    roster_file = os.path.expanduser(f'{COURSEDATA["local-box-path"]}/roster.csv')
-    with open(roster_file, encoding='utf-8') as f:
-        reader = csv.reader(f, delimiter=',')
-        rows = [row for row in reader]
-        roster_entries = [dict(zip(rows[0], row)) for row in rows]
-    # skip first entry that is the headers
-    return roster_entries[1:]
+    return list(ROSTER.refresh().entries)
 
 
 @app.route('/course-info')
@@ -596,138 +1228,246 @@ def roster():
                            roster=get_roster())
 
 
-@app.route('/grade-assignment/<label>')
-def grade_assignment(label):
-    """Copy assignments to the archive directory, and move them to the assignments
-    directory."""
-
-    roster = get_roster()
-    # the first time you visit this page, we shuffle it, but on subsequent
-    # visits we don't. The shuffle is to grade them in a different order each
-    # time.
-    # This is triggered by a url like /grade-assignment/label?shuffle=true
-    if request.args.get('shuffle'):
-        random.shuffle(roster)
-
-    with open(f'{COURSEDIR}/course-files.json', encoding='utf-8') as f:
-        data = json.loads(f.read())
+# * Collecting assignments
 
-    today = datetime.utcnow()
-    dd = data['assignments']['assignments/{}.ipynb'.format(label)]['duedate']
-    d = datetime.strptime(dd, "%Y-%m-%d %H:%M:%S")
+_HASHES = {}
+_HASHES_LOCK = threading.Lock()
 
-    if (today - d).days >= 0:
-        POSTDUE = True
-    else:
-        POSTDUE = False
 
+def file_hash(fname):
+    """Return the sha256 hex digest of FNAME, or None if it does not exist.
+    Digests are cached by path, mtime and size."""
+    try:
+        st = os.stat(fname)
+    except FileNotFoundError:
+        return None
+    key = (fname, st.st_mtime_ns, st.st_size)
+    with _HASHES_LOCK:
+        if key in _HASHES:
+            return _HASHES[key]
+
+    digest = sha256_file(fname)
+    with _HASHES_LOCK:
+        _HASHES[key] = digest
+    return digest
+
+
+def collect_submission(entry, label, postdue, collect=True):
+    """Collect the LABEL submission of the student in roster ENTRY.
+    If POSTDUE is falsy the submission is archived and moved to the assignments
+    directory. Files that are identical to the ones we have are not copied or
+    moved again. With COLLECT falsy nothing is collected, and we just look at
+    what is there. Returns a dictionary of data for the grade sheet.
+    """
     submission_dir = os.path.expanduser(f"{COURSEDATA['local-box-path']}/submissions")   # NOQA
     assignment_dir = os.path.expanduser(f"{COURSEDATA['local-box-path']}/assignments")   # NOQA
     assignment_dir = '{}/{}'.format(assignment_dir, label)
 
-    assignment_archive_dir = os.path.expanduser(f"{COURSEDATA['local-box-path']}/"  # NOQA
-                                                'assignments-archive')
-    assignment_archive_dir = '{}/{}'.format(assignment_archive_dir, label)
-
-    if not os.path.isdir(assignment_dir):
-        os.makedirs(assignment_dir)
-
-    if not os.path.isdir(assignment_archive_dir):
-        os.makedirs(assignment_archive_dir)
-
-    grade_data = []
-
-    for entry in roster:
-        andrewid = entry['Andrew ID']
-        d = {}
-        d['first-name'] = entry['Preferred/First Name']
-        d['last-name'] = entry['Last Name']
-        d['name'] = '{} {}'.format(entry['Preferred/First Name'],
-                                   entry['Last Name'])
-
-        # This is the file that was submitted
-        sfile = '{}-{}.ipynb'.format(andrewid, label)
-        SFILE = os.path.join(submission_dir, sfile)
-
-        # This is an archive copy in case anything happens.
-        AFILE = os.path.join(assignment_archive_dir, sfile)
-
-        # The logic I want to happen is:
-        # if we are not POSTDUE, copy it if it exists.
-        # If we are POSTDUE, copy it if it does not exist in the archive.
-        if ((not POSTDUE and os.path.exists(SFILE))
-            or (POSTDUE and os.path.exists(SFILE)
-                and not os.path.exists(AFILE))):
-            shutil.copy(SFILE, AFILE)
-
-        # Now we do the move. This is the file we will grade. We move it, so it
-        # will be gone from submissions. We do not move it if it has been
-        # graded.
-        GFILE = os.path.join(assignment_dir, sfile)
-
-        # We don't have the file and it is submitted we might as well collect
-        # it.
-        if not os.path.exists(GFILE) and os.path.exists(SFILE):
-            # Now we move SFILE to GFILE
+    andrewid = entry['Andrew ID']
+    d = {}
+    d['first-name'] = entry['Preferred/First Name']
+    d['last-name'] = entry['Last Name']
+    d['name'] = '{} {}'.format(entry['Preferred/First Name'],
+                               entry['Last Name'])
+
+    # This is the file that was submitted. It may have been sent compressed.
+    # The watcher may collect the same file while we do, so any of the files
+    # can disappear under us, and then it is the other collector's job.
+    sfile = '{}-{}.ipynb'.format(andrewid, label)
+    SFILE = os.path.join(submission_dir, sfile)
+    if collect:
+        for suffix in ('.gz', '.zip'):
+            if os.path.exists(SFILE + suffix):
+                try:
+                    decompress(SFILE + suffix)
+                except FileNotFoundError:
+                    pass
+    submitted = collect and os.path.exists(SFILE)
+
+    # We keep an archive copy in case anything happens.
+    # The logic I want to happen is:
+    # if we are not POSTDUE, archive it if it exists.
+    # If we are POSTDUE, archive it if it is not in the archive.
+    # The archive does not store it again if it has the same file.
+    if submitted and not (postdue and ARCHIVE.latest(andrewid, label)):
+        try:
+            ARCHIVE.put(andrewid, label, SFILE, file_hash(SFILE))
+        except FileNotFoundError:
+            submitted = False
+
+    # Now we do the move. This is the file we will grade. We move it, so it
+    # will be gone from submissions. We do not move it if it has been
+    # graded.
+    GFILE = os.path.join(assignment_dir, sfile)
+
+    # We don't have the file and it is submitted we might as well collect
+    # it.
+    if submitted and not os.path.exists(GFILE):
+        # Now we move SFILE to GFILE
+        try:
             shutil.move(SFILE, GFILE)
-
-        # here the GFILE should exist. whether we update it depends. Let's check  # NOQA
-        # if it is graded. If we have not graded it, we might as well update it.  # NOQA
-        # Check for a grade and return timestamp
-        # collect data in a dictionary
-        d['filename'] = GFILE
-        d['andrewid'] = andrewid
-        d['label'] = label
-        d['grade'] = None
-        d['turned-in'] = None
-        d['returned'] = None
-
-        if os.path.exists(GFILE):
-            with open(GFILE, encoding='utf-8') as f:
-                j = json.loads(f.read())
-                # if the file is ungraded, we go ahead and move it over.
-                if (os.path.exists(SFILE)
-                    and j['metadata'].get('grade', None) is None):
+        except FileNotFoundError:
+            pass
+        submitted = False
+
+    # here the GFILE should exist. whether we update it depends. Let's check  # NOQA
+    # if it is graded. If we have not graded it, we might as well update it.  # NOQA
+    # Check for a grade and return timestamp
+    # collect data in a dictionary
+    d['filename'] = GFILE
+    d['andrewid'] = andrewid
+    d['label'] = label
+    d['grade'] = None
+    d['turned-in'] = None
+    d['returned'] = None
+
+    md = GRADES.get(andrewid, label, GFILE)
+    if md:
+        # if the file is ungraded, we go ahead and move it over. If it is the
+        # same file we just clear it out of the submissions.
+        if submitted and not md.graded:
+            try:
+                if file_hash(SFILE) == file_hash(GFILE):
+                    os.remove(SFILE)
+                else:
                     shutil.move(SFILE, GFILE)
+            except FileNotFoundError:
+                pass
+
+        d['grade'] = md.overall
+        d['returned'] = md.returned
+        d['turned-in'] = md.turned_in
+
+    return d
+
+
+def ingest_submission(fname):
+    """Collect the submission FNAME, which is named <andrewid>-<label>.ipynb,
+    optionally with a .gz or .zip suffix. Files for students that are not on
+    the roster or labels that are not assignments are left alone."""
+    name = os.path.basename(compressed_name(fname) or fname)
+    if not name.endswith('.ipynb'):
+        return
+    andrewid, _, label = name[:-len('.ipynb')].partition('-')
+    entry = ROSTER.get(andrewid)
+    assignment = COURSE_FILES.get_course().get(label)
+    if entry is None or assignment is None:
+        return
+
+    os.makedirs(os.path.expanduser(f"{COURSEDATA['local-box-path']}/assignments/{label}"),  # NOQA
+                exist_ok=True)
+    print(f'Collecting {fname}')
+    collect_submission(entry, label, assignment.postdue())
+
+
+def start_watcher():
+    """Start watching the submissions folder, if there is one.
+    Set watch-submissions to false in the course data to turn this off, and
+    watch-interval to the polling interval in seconds."""
+    global WATCHER
+    submission_dir = os.path.expanduser(f"{COURSEDATA['local-box-path']}/submissions")   # NOQA
+    if not COURSEDATA.get('watch-submissions', True) \
+       or not os.path.isdir(submission_dir):
+        return
+    if WATCHER is None:
+        WATCHER = Watcher(submission_dir, ingest_submission,
+                          pattern='*.ipynb*',
+                          interval=COURSEDATA.get('watch-interval', 10))
+    WATCHER.start()
 
-                if j['metadata'].get('grade', None):
-                    d['grade'] = j['metadata']['grade']['overall']
-                else:
-                    d['grade'] = None
 
-                if j['metadata'].get('RETURNED', None):
-                    d['returned'] = j['metadata']['RETURNED']
-                else:
-                    d['returned'] = None
+# The last histogram for each label, with the grades it was made from.
+_HISTOGRAMS = {}
 
-                if j['metadata'].get("TURNED-IN"):
-                    d['turned-in'] = j['metadata']['TURNED-IN']['timestamp']
-                else:
-                    d['turned-in'] = None
 
-        grade_data.append(d)
+def grade_histogram(label, grades, bins=20, width=640, height=360):
+    """Return an inline svg histogram of GRADES for LABEL.
+    The svg is cached, and only made again when the grades change. Returns an
+    empty string if there are no grades.
+    """
+    if not grades:
+        return ''
+
+    key = tuple(sorted(grades))
+    cached = _HISTOGRAMS.get(label, None)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    import numpy as np
+    from html import escape
+    counts, edges = np.histogram(grades, bins=bins,
+                                 range=(0, max(1.0, max(grades))))
+
+    # plot area inside the axes labels and title
+    x0, x1, y0, y1 = 60, width - 20, height - 50, 50
+    ymax = max(1, counts.max())
+    sx = (x1 - x0) / (edges[-1] - edges[0])
+    sy = (y0 - y1) / ymax
+
+    svg = [f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" '
+           f'height="{height}" font-family="sans-serif" font-size="12">',
+           f'<text x="{width / 2}" y="20" text-anchor="middle" font-size="14">'
+           f'Grade distribution for {escape(label)}</text>',
+           f'<text x="{width / 2}" y="38" text-anchor="middle" font-size="14">'
+           f'Mean={np.mean(grades):1.2f}</text>']
+
+    for count, left, right in zip(counts, edges[:-1], edges[1:]):
+        if count:
+            svg += [f'<rect x="{x0 + left * sx:.1f}" y="{y0 - count * sy:.1f}" '
+                    f'width="{(right - left) * sx:.1f}" '
+                    f'height="{count * sy:.1f}" fill="#1f77b4" '
+                    f'stroke="white"/>']
+
+    svg += [f'<line x1="{x0}" y1="{y0}" x2="{x1}" y2="{y0}" stroke="black"/>',
+            f'<line x1="{x0}" y1="{y0}" x2="{x0}" y2="{y1}" stroke="black"/>']
+    for tick in np.linspace(0, edges[-1], 6):
+        svg += [f'<text x="{x0 + tick * sx:.1f}" y="{y0 + 16}" '
+                f'text-anchor="middle">{tick:g}</text>']
+    for tick in range(0, ymax + 1, max(1, ymax // 5)):
+        svg += [f'<text x="{x0 - 6}" y="{y0 - tick * sy + 4:.1f}" '
+                f'text-anchor="end">{tick}</text>']
+    svg += [f'<text x="{(x0 + x1) / 2}" y="{height - 12}" '
+            'text-anchor="middle">Grade</text>',
+            f'<text x="16" y="{(y0 + y1) / 2}" text-anchor="middle" '
+            f'transform="rotate(-90 16 {(y0 + y1) / 2})">Frequency</text>',
+            '</svg>']
+
+    svg = '\n'.join(svg)
+    _HISTOGRAMS[label] = (key, svg)
+    return svg
+
+
+def collect_assignment(label, roster, collect=True, progress=None):
+    """Collect LABEL for each student in ROSTER.
+    With COLLECT falsy we only look at what is already collected. PROGRESS is
+    an optional dictionary that is updated as students are done. Returns a
+    list of grade sheet dictionaries in the order of ROSTER.
+    """
+    from concurrent.futures import ThreadPoolExecutor
 
-    # this puts a figure inline in the page of the grade distribution.
-    numeric_grades = [d['grade'] for d in grade_data if d['grade'] is not None]
-    if numeric_grades:
-        from io import BytesIO
-        import base64
-        plt.hist(numeric_grades, 20)
-        plt.xlabel('Grade')
-        plt.ylabel('Frequency')
-        plt.xlim([0, 1])
-        plt.title('Grade distribution for {}\nMean={:1.2f}'.format(label,
-                                                                   np.mean(numeric_grades)))  # NOQA
-        png = BytesIO()
-        plt.savefig(png)
-        plt.close()
-        png.seek(0)
-        histogram = urllib.parse.quote(base64.b64encode(png.read()))
-    else:
-        histogram = ""
+    POSTDUE = COURSE_FILES.get_course().get(label).postdue()
 
-    # Add this function so we can use it in a template
-    app.jinja_env.globals.update(exists=os.path.exists)
+    os.makedirs(os.path.expanduser(f"{COURSEDATA['local-box-path']}/assignments/{label}"),  # NOQA
+                exist_ok=True)
+    # Archives from before the archive store are moved into it.
+    ARCHIVE.migrate(label)
+
+    if progress is None:
+        progress = {}
+    progress.update(total=len(roster), done=0)
+
+    # The Box folder can be slow, so we do this in parallel.
+    grade_data = []
+    with ThreadPoolExecutor(COURSEDATA.get('collect-workers', 8)) as pool:
+        # Each task runs in a copy of our context, so the metrics are counted
+        # for this route.
+        futures = [pool.submit(contextvars.copy_context().run,
+                               collect_submission, entry, label, POSTDUE,
+                               collect)
+                   for entry in roster]
+        for future in futures:
+            grade_data += [future.result()]
+            progress['done'] += 1
 
     status_file = os.path.expanduser(f"{COURSEDATA['local-box-path']}/assignments/{label}/STATUS")   # NOQA
 
@@ -738,13 +1478,96 @@ def grade_assignment(label):
         with open(status_file, 'w', encoding='utf-8') as f:
             f.write('Collected')
 
+    return grade_data
+
+
+@app.route('/grade-assignment/<label>')
+def grade_assignment(label):
+    """Copy assignments to the archive directory, and move them to the assignments
+    directory.
+    The collection is a job, so only one runs for a label at a time. With a
+    background parameter we redirect to its status, otherwise we wait for it
+    (or the one already running) and show what was collected. If it is not
+    done in 'collect-wait' seconds (10 by default), e.g. because other jobs
+    have the workers, we show what we have with a note that it is still
+    going."""
+    def start():
+        return JOBS.submit('collect', label,
+                           lambda job: collect_assignment(
+                               label, get_roster(), progress=job.progress)
+                           and None)
+
+    if request.args.get('background'):
+        return redirect(url_for('job_status', id=start().id))
+
+    # When the submissions watcher is running it collects new files as they
+    # come in, and we only need to look at what we have.
+    collecting = None
+    if not (WATCHER and WATCHER.running()):
+        job = start()
+        if not job.wait(COURSEDATA.get('collect-wait', 10)):
+            collecting = job
+        elif job.status == 'failed':
+            raise Exception(f'Collecting {label} failed: {job.error}')
+
+    roster = get_roster()
+    # the first time you visit this page, we shuffle it, but on subsequent
+    # visits we don't. The shuffle is to grade them in a different order each
+    # time.
+    # This is triggered by a url like /grade-assignment/label?shuffle=true
+    if request.args.get('shuffle'):
+        random.shuffle(roster)
+
+    grade_data = collect_assignment(label, roster, collect=False)
+
+    # this puts a figure inline in the page of the grade distribution.
+    numeric_grades = [d['grade'] for d in grade_data if d['grade'] is not None]
+    histogram = grade_histogram(label, numeric_grades)
+
+    # Add this function so we can use it in a template
+    app.jinja_env.globals.update(exists=os.path.exists)
+
     return render_template('grade-assignment.html',
                            COURSE=COURSE,
+                           collecting=collecting,
                            label=label,
                            histogram=histogram,
                            grade_data=grade_data)
 
 
+@app.route('/archive/<label>')
+def archive_list(label):
+    "Return the archived versions of the label submissions as json."
+    return jsonify(ARCHIVE.list(label))
+
+
+@app.route('/archive/<label>/<andrewid>')
+def archive_restore(label, andrewid):
+    """Download an archived version of the andrewid submission for label.
+    The version parameter is an index into the versions, the newest by
+    default."""
+    from flask import send_file
+    try:
+        version = int(request.args.get('version', -1))
+    except ValueError:
+        return jsonify({'error': 'version should be an integer'}), 400
+    versions = ARCHIVE.versions(andrewid, label)
+    if not versions:
+        return jsonify({'error': f'No archived {label} for {andrewid}'}), 404
+    if not -len(versions) <= version < len(versions):
+        return jsonify({'error': f'No version {version} of {label} for '
+                        f'{andrewid}, there are {len(versions)}'}), 404
+    digest = versions[version]['digest']
+    return send_file(ARCHIVE.blob_path(digest), as_attachment=True,
+                     download_name=f'{andrewid}-{label}.ipynb')
+
+
+@app.route('/archive-verify')
+def archive_verify():
+    "Check the archive and return the bad blobs as json."
+    return jsonify(ARCHIVE.verify(COURSEDATA.get('collect-workers', 8)))
+
+
 @app.route('/grade/<andrewid>/<label>')
 def grade(andrewid, label):
     "Opens the file for andrewid and label."
@@ -753,20 +1576,15 @@ def grade(andrewid, label):
                          label,
                          f'{andrewid}-{label}.ipynb')
 
-    with open(GFILE, encoding='utf-8') as f:
-        j = json.loads(f.read())
-        if j['metadata'].get('grade', None) is None:
-            print('No grade in {} yet'.format(GFILE))
-        else:
-            tech = j['metadata']['grade']['technical']
-            pres = j['metadata']['grade']['presentation']
-            print('grade: ', ('technical', tech), ('presentation', pres))
+    md = read_notebook_metadata(GFILE)
+    if not md.graded:
+        print('No grade in {} yet'.format(GFILE))
+    else:
+        print('grade: ', ('technical', md.technical),
+              ('presentation', md.presentation))
 
     # Now open the notebook.
-    cmd = ["jupyter", "notebook", GFILE]
-    subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                     stderr=subprocess.PIPE,
-                     stdin=subprocess.PIPE)
+    open_notebook(GFILE, os.path.expanduser(COURSEDATA['local-box-path']))
 
     return ('', 204)
 
@@ -779,28 +1597,24 @@ def open_for_grading(label, n=5):
     all_ipynb = glob.glob(assignment_dir + '/' + label + '/*.ipynb')
     ungraded = []
     for ipynb in all_ipynb:
-        with open(ipynb) as f:
-            data = json.loads(f.read())
-            if 'grade' not in data['metadata']:
-                ungraded += [ipynb]
+        if not read_notebook_metadata(ipynb).graded:
+            ungraded += [ipynb]
     random.shuffle(ungraded)
     for i in range(min(n, len(ungraded))):
         # Now open the notebooks.
-        cmd = ["jupyter", "notebook", ungraded[i]]
-        print( f'Running "{cmd}")')
-        subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE,
-                         stdin=subprocess.PIPE)
+        print(f'Opening {ungraded[i]}')
+        open_notebook(ungraded[i],
+                      os.path.expanduser(COURSEDATA['local-box-path']))
     return ('', 204)
 
 
-@app.route('/return/<andrewid>/<label>')
-def return_one(andrewid, label):
-    """Return an assignment by email.
-    If a force parameter is given return even if it was returned before.
+def return_assignment(andrewid, label, force=False, report=None):
+    """Return the graded LABEL assignment of ANDREWID by email.
+    Returns a string for what happened: 'missing', 'ungraded', 'returned' if it
+    was returned before (and FORCE is not truthy) or 'sent'. The RETURNED stamp
+    is saved in the file after the email is sent. REPORT is the grade report
+    to put in the email; it is made with `grade_report' if it is None.
     """
-    force = True if request.args.get('force') else False
-
     assignment_dir = os.path.expanduser(f"{COURSEDATA['local-box-path']}/assignments")   # NOQA
     GFILE = os.path.join(assignment_dir,
                          label,
@@ -808,23 +1622,22 @@ def return_one(andrewid, label):
     # Make sure file exists
     if not os.path.exists(GFILE):
         print('{} not found.'.format(GFILE))
-        return redirect(url_for('grade_assignment', label=label))
+        return 'missing'
 
     # Check for grade, we don't return ungraded files
-    with open(GFILE, encoding='utf-8') as f:
-        j = json.loads(f.read())
-        if j['metadata'].get('grade', None) is None:
-            print('No grade in {}. not returning.'.format(GFILE))
-            return redirect(url_for('grade_assignment', label=label))
-        tech = j['metadata']['grade']['technical']
-        pres = j['metadata']['grade']['presentation']
-        grade = j['metadata']['grade']['overall']
-        print('grade: ', ('technical', tech), ('presentation', pres))
+    md = read_notebook_metadata(GFILE)
+    if not md.graded:
+        print('No grade in {}. not returning.'.format(GFILE))
+        return 'ungraded'
+    tech = md.technical
+    pres = md.presentation
+    grade = md.overall
+    print('grade: ', ('technical', tech), ('presentation', pres))
     # Check if it was already returned, we don't return it again unless force
     # is truthy.
-    if j['metadata'].get('RETURNED', None) and not force:
+    if md.returned and not force:
         print('Returned already!')
-        return redirect(url_for('grade_assignment', label=label))
+        return 'returned'
 
     # ok, finally we have to send it back.
     EMAIL = '{}@andrew.cmu.edu'.format(andrewid)
@@ -844,12 +1657,11 @@ def return_one(andrewid, label):
                                                                         pres,
                                                                         grade)
 
-    ctype = 'application/octet-stream'
-    maintype, subtype = ctype.split('/', 1)
-
-    # Save some return data.
-    with open(GFILE, encoding='utf-8') as f:
-        j = json.loads(f.read())
+    # Save some return data. We parse the notebook once for the comments, and
+    # the RETURNED stamp is patched into the bytes we read.
+    with open(GFILE, 'rb') as f:
+        content = f.read()
+    j = parse_notebook(content)
 
     # Now we add the comments to the email body.
     i = 1
@@ -864,240 +1676,458 @@ def return_one(andrewid, label):
         body += '\n'.join(comments)
 
     # Let's put a grade report in too.
-    grades = get_grades(andrewid)
-    # we need to delete some keys I made for convenience.
-    del grades['course-overall-grade']
-    del grades['name']
-    del grades['first-name']
-    del grades['last-name']
-    # grades is a dictionary by label.
-
-    # here we make it a list
-    grades = [(k, v) for k, v in grades.items()]
-
-    # Now we sort by the duedate. This function gets the datetime object for an
-    # assignment for sorting.
-
-    def mydate(el):
-        k, v = el
-        dd = v['duedate']
-        d = datetime.strptime(dd, "%Y-%m-%d %H:%M:%S")
-        return d
-
-    grades = sorted(grades, key=lambda el: mydate(el), reverse=True)
-
-    today = datetime.utcnow()
-    gstring = '{0:35s} {1:15s} {2:8s} {3:10s} {4}'.format('label',
-                                                          'grade',
-                                                          'points',
-                                                          'category',
-                                                          'duedate')
-    gstring += '\n' + "-" * len(gstring)
-
-    with open(f'{COURSEDIR}/course-files.json'.format(COURSEDIR),
-              encoding='utf-8') as f:
-        data = json.loads(f.read())
-        adata = {}
-        for k, v in data['assignments'].items():
-            adata[v['label']] = v
+    if report is None:
+        report = grade_report(andrewid)
 
-    for label, v in grades:
-        p = v['path']  # path to student file
-        dd = adata[label]['duedate']
-        category = adata[label]['category']
-        g = v.get('overall', 0.0)  # student grade
-        points = str(adata[label]['points'])
+    body += '\n\nGrades\n======\n'
+    body += report
 
-        d = datetime.strptime(dd, "%Y-%m-%d %H:%M:%S")
+    dt = datetime.now()
+    content = patch_notebook_metadata(
+        content, lambda md: md.update({'RETURNED': dt.isoformat(" ")}))
 
-        if (today - d).days >= 0:
-            POSTDUE = True
-        else:
-            POSTDUE = False
-
-        if POSTDUE and os.path.exists(p) and g is not None:
-            gstring += '\n{0:35s} {1:15.3f} {4:^8s} {2:15s} {3}'.format(label, g, category, dd, points)  # NOQA
-        elif POSTDUE and os.path.exists(p) and g is None:
-            gstring += '\n{0:35s} {1:>15s} {4:^8s} {2:15s} {3}'.format(label,
-                                                                       'not-graded', category, dd, # NOQA
-                                                                       points)
-        elif POSTDUE:
-            gstring += '\n{0:35s} {1:>15s} {4:^8s} {2:15s} {3}'.format(label,
-                                                                       'missing', category,   # NOQA
-                                                                       dd,
-                                                                       points)
+    msg.attach(mail_attachment(content, os.path.split(GFILE)[-1]))
 
-    body += '\n\nGrades\n======\n'
-    body += gstring
+    msg.attach(MIMEText(body, 'plain'))
 
-    dt = datetime.now()
-    j['metadata']['RETURNED'] = dt.isoformat(" ")
+    print(f'Sending {msg["Subject"]} to {msg["To"]}')
 
-    with open(GFILE, 'w', encoding='utf-8') as f:
-        f.write(json.dumps(j))
+    get_mailer().send(msg)
 
-    with open(GFILE, 'rb') as fp:
-        attachment = MIMEBase(maintype, subtype)
-        attachment.set_payload(fp.read())
-        # Encode the payload using Base64
-        encoders.encode_base64(attachment)
-        # Set the filename parameter
-        attachment.add_header('Content-Disposition', 'attachment',
-                              filename=os.path.split(GFILE)[-1])
-        msg.attach(attachment)
+    write_atomic(GFILE, content)
 
-    msg.attach(MIMEText(body, 'plain'))
+    return 'sent'
 
-    print(msg)
 
-    with smtplib.SMTP_SSL('relay.andrew.cmu.edu', port=465) as s:
-        s.send_message(msg)
-        s.quit()
+@app.route('/return/<andrewid>/<label>')
+def return_one(andrewid, label):
+    """Return an assignment by email.
+    If a force parameter is given return even if it was returned before.
+    """
+    force = True if request.args.get('force') else False
+
+    if return_assignment(andrewid, label, force) != 'sent':
+        return redirect(url_for('grade_assignment', label=label))
 
     return ('', 204)
 
+# ** Returning all the assignments
 
-@app.route('/return-all/<label>')
-def return_all(label):
-    """Return all the assignments for label."""
 
-    roster = get_roster()
+def return_journal(label):
+    """Return the path to the return journal for LABEL.
+    This file has a line for each student whose assignment was returned by a
+    bulk return, so an interrupted return can pick up where it stopped.
+    """
+    return os.path.join(os.path.expanduser(f"{COURSEDATA['local-box-path']}/assignments/"),   # NOQA
+                        label, "RETURN-JOURNAL")
+
+
+def read_return_journal(label):
+    "Return the set of Andrew IDs in the return journal for LABEL."
+    journal = return_journal(label)
+    if not os.path.exists(journal):
+        return set()
+    with open(journal, encoding='utf-8') as f:
+        return {line.split()[0] for line in f if line.strip()}
+
+
+def return_all_assignments(label, progress):
+    """Return LABEL to everyone on the roster who is not in the journal.
+    The grade reports for everyone are made in one pass first. The emails are
+    built and sent in a pool of threads, and PROGRESS (a dictionary) is
+    updated as each one finishes.
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    done = read_return_journal(label)
+    roster = [d for d in get_roster() if d['Andrew ID'] not in done]
     andrewids = [d['Andrew ID'] for d in roster]
+    progress.update(total=len(andrewids) + len(done), done=len(done),
+                    sent=0, returned=0, missing=0, ungraded=0, failed=0,
+                    errors=[])
+    reports = dict(compute_gradebook(roster).reports())
+
+    with open(return_journal(label), 'a', encoding='utf-8') as journal, \
+         ThreadPoolExecutor(COURSEDATA.get('return-workers', 8)) as pool:
+        futures = {pool.submit(contextvars.copy_context().run,
+                               return_assignment, andrewid, label, False,
+                               reports[andrewid]): andrewid
+                   for andrewid in andrewids}
+        for future in as_completed(futures):
+            andrewid = futures[future]
+            try:
+                status = future.result()
+            except Exception as e:
+                status = 'failed'
+                progress['errors'] += [f'{andrewid}: {e}']
+
+            if status in ('sent', 'returned'):
+                journal.write(f'{andrewid} {datetime.now().isoformat("T")}\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+
+            progress[status] += 1
+            progress['done'] += 1
+
+    if not progress['failed']:
+        status_file = os.path.join(os.path.expanduser(f"{COURSEDATA['local-box-path']}/assignments/"),   # NOQA
+                                   label, "STATUS")
 
-    for andrewid in andrewids:
-        return_one(andrewid, label)
-        time.sleep(1)
+        with open(status_file, 'w', encoding='utf-8') as f:
+            f.write('Returned')
 
-    status_file = os.path.join(os.path.expanduser(f"{COURSEDATA['local-box-path']}/assignments/"),   # NOQA
-                               label, "STATUS")
 
-    with open(status_file, 'w', encoding='utf-8') as f:
-        f.write('Returned')
+@app.route('/return-all/<label>')
+def return_all(label):
+    """Return all the assignments for label.
+    This is queued as a job; poll /return-all/label/progress to see how it is
+    going. Running it again after an interruption skips the students that were
+    already done."""
+    JOBS.submit('return-all', label,
+                lambda job: return_all_assignments(label, job.progress))
 
     return redirect(url_for('grade_assignment', label=label))
 
 
-def get_grades(andrewid):
-    """Return a dictionary of grades for andrewid."""
-    with open(f'{COURSEDIR}/course-files.json', encoding='utf-8') as f:
-        data = json.loads(f.read())
+@app.route('/return-all/<label>/progress')
+def return_all_progress(label):
+    "Return the progress of the bulk return of label as json."
+    job = JOBS.latest('return-all', label)
+    if job is None:
+        return jsonify({'running': False})
+    progress = dict(job.progress, running=job.active)
+    if job.error:
+        progress['errors'] = progress.get('errors', []) + [job.error]
+    return jsonify(progress)
+
+
+# * Metrics
+
+@app.route('/metrics')
+def metrics():
+    "Return the request timings and counters in the Prometheus text format."
+    return (METRICS.render(), 200,
+            {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+# * Jobs
+
+@app.route('/jobs')
+def job_list():
+    "Return the queued, running and recent jobs as json."
+    return jsonify([job.as_dict() for job in JOBS.all()])
+
+
+@app.route('/jobs/<int:id>')
+def job_status(id):
+    "Return the status and progress of job id as json."
+    job = JOBS.get(id)
+    if job is None:
+        return jsonify({'error': f'No job {id}'}), 404
+    return jsonify(job.as_dict())
+
+
+class Gradebook:
+    """Grades for a set of students on all the assignments in a course.
+    The grades are stored in students x assignments arrays so the course grades
+    for everyone are computed in one pass. Use `compute_gradebook' to make one.
+
+    Attributes:
+    roster - the roster entries, one per row
+    andrewids - the andrew ids, one per row
+    labels, paths, duedates - one per column, in course-files.json order
+    assignment_categories - the category of each assignment
+    categories - the category names from COURSEDATA
+    points, weights - the points and category weight of each assignment
+    postdue - True for assignments past their due date
+    scores - overall grades, nan when there is no grade
+    technical, presentation - object arrays of the rubric grades
+    missing - post-due assignments with no file
+    not_graded - post-due assignments with a file but no grade
+    overall - the course overall grade for each student
+    category_grades - students x categories grades, nan with nothing to grade
+
+    `table' turns it into rows with a choice of the COLUMNS groups.
+    """
 
-    # Next get assignments. These are in assignments/label.ipynb For students I
-    # construct assignments/andrewid-label.ipynb to check if they have local
-    # versions.
-    assignments = data['assignments']
+    # name - first name, last name, andrew id
+    # overall - the course overall grade
+    # categories - the grade in each category
+    # scores - the overall grade of each assignment
+    # rubric - the technical and presentation grade of each assignment
+    COLUMNS = ('name', 'overall', 'categories', 'scores', 'rubric')
+
+    def __init__(self, roster, course, categories, assignment_dir):
+        import numpy as np
+        self.roster = roster
+        self.assignment_dir = assignment_dir
+        self.andrewids = [d['Andrew ID'] for d in roster]
+        self.rows = {andrewid: i for i, andrewid in enumerate(self.andrewids)}
+
+        self.paths = [a.path for a in course]
+        self.labels = [a.label for a in course]
+        self.duedates = [a.duedate for a in course]
+        self.due = [a.due or 0 for a in course]
+        self.assignment_categories = [a.category for a in course]
+        self.assignment_points = [a.points for a in course]
+
+        names, weights = categories
+        self.categories = list(names)
+        category_weights = dict(zip(names, weights))
+
+        self.points = np.array([_points(p) for p in self.assignment_points],
+                               dtype=float)
+        self.weights = np.array([category_weights.get(cat, 0.0)
+                                 for cat in self.assignment_categories],
+                                dtype=float)
+        # assignments x categories membership matrix
+        self.membership = np.array([[cat == name for name in self.categories]
+                                    for cat in self.assignment_categories],
+                                   dtype=float).reshape(len(self.paths),
+                                                        len(self.categories))
+
+        now = time.time()
+        self.postdue = np.array([a.postdue(now) for a in course], dtype=bool)
+
+        shape = (len(self.andrewids), len(self.paths))
+        self.scores = np.full(shape, np.nan)
+        self.technical = np.full(shape, None, dtype=object)
+        self.presentation = np.full(shape, None, dtype=object)
+        self.missing = np.zeros(shape, dtype=bool)
+        self.not_graded = np.zeros(shape, dtype=bool)
+
+    def student_file(self, andrewid, label):
+        "Return the path to the graded file of ANDREWID for LABEL."
+        return f'{self.assignment_dir}/{label}/{andrewid}-{label}.ipynb'
+
+    def fill(self, progress=None):
+        """Read the grades of the post-due assignments from the grade index.
+        PROGRESS is an optional dictionary updated as each label is read."""
+        if progress is None:
+            progress = {}
+        progress.update(total=int(self.postdue.sum()), done=0)
+        for j, label in enumerate(self.labels):
+            if not self.postdue[j]:
+                continue
+            for i, andrewid in enumerate(self.andrewids):
+                md = GRADES.get(andrewid, label,
+                                self.student_file(andrewid, label))
+                if md is None:
+                    self.missing[i, j] = True
+                elif md.graded:
+                    if md.overall is not None:
+                        self.scores[i, j] = md.overall
+                    self.technical[i, j] = md.technical
+                    self.presentation[i, j] = md.presentation
+                else:
+                    self.not_graded[i, j] = True
+            progress['done'] += 1
+
+    def compute(self):
+        """Compute the overall and category grades for every student.
+        Missing assignments count as zero, and assignments that are turned in
+        but not graded yet are left out.
+        """
+        import numpy as np
+        # The assignments that count for each student
+        counted = self.postdue & ~self.not_graded
+        earned = np.where(counted, np.nan_to_num(self.scores), 0.0)
+        possible = counted.astype(float)
+        w = self.points * self.weights
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.overall = (earned @ w) / (possible @ w)
+            self.category_grades = ((earned * self.points) @ self.membership
+                                    / ((possible * self.points)
+                                       @ self.membership))
+        return self
+
+    def grades(self, andrewid):
+        """Return the dictionary of grades for ANDREWID that get_grades returns.
+        Post-due assignments are included when they are graded or missing.
+        """
+        import numpy as np
+        i = self.rows[andrewid]
+        grades = {}
+        for j, label in enumerate(self.labels):
+            if self.not_graded[i, j] or not self.postdue[j]:
+                continue
+            score = self.scores[i, j]
+            grades[label] = {'andrewid': andrewid,
+                             'path': self.student_file(andrewid, label),
+                             'technical': self.technical[i, j],
+                             'presentation': self.presentation[i, j],
+                             'overall': None if np.isnan(score) else float(score),
+                             'category': self.assignment_categories[j],
+                             'points': self.assignment_points[j],
+                             'duedate': self.duedates[j]}
+
+        entry = self.roster[i]
+        if 'Last Name' in entry:
+            grades['first-name'] = entry['Preferred/First Name']
+            grades['last-name'] = entry['Last Name']
+            grades['name'] = '{} {}'.format(entry['Preferred/First Name'],
+                                            entry['Last Name'])
+
+        grades['course-overall-grade'] = float(self.overall[i])
+        return grades
+
+    def reports(self, rows=None):
+        """Generate (andrewid, report) for the students in ROWS, a list of row
+        indices (everyone by default). A report is the table of post-due
+        grades, latest first, that goes in the email with a returned
+        assignment. The order and headings are worked out once for everyone.
+        """
+        import numpy as np
+        order = sorted(np.flatnonzero(self.postdue),
+                       key=lambda j: self.due[j], reverse=True)
+        heading = '{0:35s} {1:15s} {2:8s} {3:10s} {4}'.format('label',
+                                                              'grade',
+                                                              'points',
+                                                              'category',
+                                                              'duedate')
+        heading += '\n' + "-" * len(heading)
+
+        for i in range(len(self.andrewids)) if rows is None else rows:
+            report = heading
+            for j in order:
+                if self.not_graded[i, j]:
+                    continue
+                label = self.labels[j]
+                category = self.assignment_categories[j]
+                dd = self.duedates[j]
+                points = str(self.assignment_points[j])
+                if self.missing[i, j]:
+                    report += '\n{0:35s} {1:>15s} {4:^8s} {2:15s} {3}'.format(label, 'missing', category, dd, points)  # NOQA
+                elif np.isnan(self.scores[i, j]):
+                    report += '\n{0:35s} {1:>15s} {4:^8s} {2:15s} {3}'.format(label, 'not-graded', category, dd, points)  # NOQA
+                else:
+                    report += '\n{0:35s} {1:15.3f} {4:^8s} {2:15s} {3}'.format(label, self.scores[i, j], category, dd, points)  # NOQA
+            yield self.andrewids[i], report
+
+    def headings(self, columns=('name', 'overall', 'scores')):
+        "Return the headings of a table with the COLUMNS groups."
+        headings = []
+        for column in columns:
+            if column == 'name':
+                headings += ['First name', 'Last name', 'Andrew ID']
+            elif column == 'overall':
+                headings += ['Overall']
+            elif column == 'categories':
+                headings += self.categories
+            elif column == 'scores':
+                headings += self.labels
+            elif column == 'rubric':
+                for label in self.labels:
+                    headings += [f'{label} technical',
+                                 f'{label} presentation']
+            else:
+                raise Exception(f'Unknown gradebook column {column}')
+        return headings
+
+    def row(self, i, columns=('name', 'overall', 'scores')):
+        """Return the row of student I with the COLUMNS groups.
+        Grades are rounded like on the gradebook page, and missing ones are
+        None."""
+        import numpy as np
+
+        def number(x, digits):
+            return None if np.isnan(x) else round(float(x), digits)
+
+        row = []
+        for column in columns:
+            if column == 'name':
+                entry = self.roster[i]
+                row += [entry.get('Preferred/First Name'),
+                        entry.get('Last Name'),
+                        self.andrewids[i]]
+            elif column == 'overall':
+                row += [number(self.overall[i], 3)]
+            elif column == 'categories':
+                row += [number(x, 3) for x in self.category_grades[i]]
+            elif column == 'scores':
+                row += [number(x, 2) for x in self.scores[i]]
+            elif column == 'rubric':
+                for j in range(len(self.labels)):
+                    row += [self.technical[i, j], self.presentation[i, j]]
+            else:
+                raise Exception(f'Unknown gradebook column {column}')
+        return row
+
+    def table(self, columns=('name', 'overall', 'scores')):
+        "Generate the rows of all students with the COLUMNS groups."
+        for i in range(len(self.andrewids)):
+            yield self.row(i, columns)
 
-    assignment_paths = assignments.keys()
 
-    assignment_files = [os.path.split(path)[-1]
-                        for path in assignment_paths]
+def _points(points):
+    "Convert the POINTS of an assignment to a number. Unknown points are 0."
+    try:
+        return int(points or 0)
+    except ValueError:
+        return 0
 
-    assignment_labels = [os.path.splitext(f)[0] for f in assignment_files]
 
+def compute_gradebook(roster, progress=None):
+    """Return a computed Gradebook for the ROSTER entries.
+    PROGRESS is an optional dictionary updated as the grades are read."""
     assignment_dir = os.path.expanduser(f"{COURSEDATA['local-box-path']}/assignments")   # NOQA
+    gb = Gradebook(roster, COURSE_FILES.get_course(), COURSEDATA['categories'],
+                   assignment_dir)
+    gb.fill(progress)
+    return gb.compute()
 
-    duedates = [assignments[path]['duedate'] for path in assignment_paths]
-
-    grades = {}
-
-    for label, dd in zip(assignment_labels, duedates):
-        today = datetime.utcnow()
-        d = datetime.strptime(dd, "%Y-%m-%d %H:%M:%S")
-
-        # We only look at assignments that are post due
-        if (today - d).days >= 0:
-            # the student file
-            sfile = '{assignment_dir}/{label}/{andrewid}-{label}.ipynb'.format(**locals())
-
-            if os.path.exists(sfile):
-                with open(sfile, encoding='utf-8') as f:
-                    j = json.loads(f.read())
-                    if j['metadata'].get('grade', None):
-                        grades[label] = {'andrewid': andrewid,
-                                         'path': sfile,
-                                         'technical': j['metadata']['grade']['technical'],
-                                         'presentation': j['metadata']['grade']['presentation'],
-                                         'overall': j['metadata']['grade']['overall'],
-                                         'category': assignments['assignments/{}.ipynb'.format(label)]['category'],
-                                         'points': assignments['assignments/{}.ipynb'.format(label)]['points'],
-                                         'duedate': assignments['assignments/{}.ipynb'.format(label)]['duedate']}
-            else:
-                grades[label] = {'andrewid': andrewid,
-                                 'technical': None,
-                                 'presentation': None,
-                                 'overall': None,
-                                 'category': assignments['assignments/{}.ipynb'.format(label)]['category'],
-                                 'points': assignments['assignments/{}.ipynb'.format(label)]['points'],
-                                 'duedate': assignments['assignments/{}.ipynb'.format(label)]['duedate'],
-                                 'path': sfile}
-
-    # add name
-    roster = get_roster()
-    for d in roster:
-        if andrewid == d['Andrew ID']:
-            grades['first-name'] = d['Preferred/First Name']
-            grades['last-name'] = d['Last Name']
-            grades['name'] = '{} {}'.format(d['Preferred/First Name'],
-                                            d['Last Name'])
-            break
-
-    # Compute overall grade
-    # these are the categories and weights
-    categories = dict(list(zip(*COURSEDATA['categories'])))
-    # categories = {'homework': 0.15,
-    #               'exam1': 0.2,
-    #               'exam2': 0.3,
-    #               'final': 0.35}
-
-    overall_possible_points = 0
-    overall_earned_points = 0
-    for key in grades:
-        if key not in assignment_labels:
-            continue
-        cat = grades[key]['category']
-
-        possible_points = int(grades[key].get('points', 0) or 0)
-        overall_grade = float(grades[key]['overall'] or 0.0)
-
-        overall_earned_points += overall_grade * possible_points * categories[cat]
-        overall_possible_points += possible_points * categories[cat]
-        # GRADED = False
-        # f = os.path.join(os.path.expanduser(f"{COURSEDATA['local-box-path']}/assignments"),
-        #                  key, "STATUS")
-        # if os.path.exists(f):
-        #     with open(f, encoding='utf-8') as tf:
-        #         status = tf.read()
-        #             print(status)
-        #             if status == 'Returned':
-        #                 GRADED = True
-        #     print(f, os.path.exists(f), 'PD', POSTDUE, 'GRaded: ', GRADED)
-        #     if POSTDUE and GRADED:
-        #         possible_points = int(grades[key].get('points', 0) or 0)
-        #         overall_grade = float(grades[key]['overall'] or 0.0)
-
-        #         overall_earned_points += overall_grade * possible_points * categories[cat]
-        #         overall_possible_points += possible_points * categories[cat]
-
-    grades['course-overall-grade'] = overall_earned_points / overall_possible_points
-    return grades
+
+_GRADEBOOK = None
+_GRADEBOOK_LOCK = threading.Lock()
+
+
+def get_gradebook(max_age=None):
+    """Return a computed Gradebook for everyone on the roster.
+    It is cached, and computed again when the roster or the course files
+    change, or when it is older than MAX_AGE seconds (the gradebook-max-age key
+    in the course data, 30 by default). Treat it as read-only.
+    """
+    global _GRADEBOOK
+    if max_age is None:
+        max_age = COURSEDATA.get('gradebook-max-age', 30)
+    ROSTER.refresh()
+    COURSE_FILES.get()
+    key = (ROSTER.mtime, COURSE_FILES.version)
+    with _GRADEBOOK_LOCK:
+        if (_GRADEBOOK and _GRADEBOOK[0] == key
+                and time.time() - _GRADEBOOK[1] < max_age):
+            return _GRADEBOOK[2]
+        gb = compute_gradebook(get_roster())
+        _GRADEBOOK = (key, time.time(), gb)
+        return gb
+
+
+def get_grades(andrewid):
+    """Return a dictionary of grades for andrewid."""
+    entry = ROSTER.get(andrewid) or {'Andrew ID': andrewid}
+    gb = compute_gradebook([entry])
+    return gb.grades(andrewid)
+
+
+def grade_report(andrewid):
+    """Return the grade report of andrewid.
+    To make the reports of many students use `Gradebook.reports'."""
+    entry = ROSTER.get(andrewid) or {'Andrew ID': andrewid}
+    gb = compute_gradebook([entry])
+    return next(gb.reports())[1]
 
 
 @app.route('/gradebook_one/<andrewid>')
 def gradebook_one(andrewid):
     """Gather grades for andrewid."""
 
-    grades = get_grades(andrewid)
-    with open('{}/course-files.json'.format(COURSEDIR), encoding='utf-8') as f:
-        data = json.loads(f.read())
-
-    # Next get assignments. These are in assignments/label.ipynb For students I
-    # construct assignments/andrewid-label.ipynb to check if they have local
-    # versions.
-    assignments = data['assignments']
-
-    assignment_files = [os.path.split(assignment)[-1]
-                        for assignment in assignments]
-    assignment_labels = [os.path.splitext(f)[0] for f in assignment_files]
+    entry = ROSTER.get(andrewid) or {'Andrew ID': andrewid}
+    gb = compute_gradebook([entry])
+    grades = gb.grades(andrewid)
+    report = next(gb.reports())[1]
+    assignment_labels = [a.label for a in COURSE_FILES.get_course()]
 
     return render_template('gradebook_one.html',
                            COURSE=COURSE,
@@ -1105,58 +2135,225 @@ def gradebook_one(andrewid):
                            andrewid=andrewid,
                            course_overall_grade=round(grades['course-overall-grade'], 3),
                            assignment_labels=assignment_labels,
-                           grades=grades)
+                           grades=grades,
+                           report=report)
 
 @app.route('/gradebook')
 def gradebook():
-
-    with open('{}/course-files.json'.format(COURSEDIR), encoding='utf-8') as f:
-        data = json.loads(f.read())
-
-    # Next get assignments. These are in assignments/label.ipynb For students I
-    # construct assignments/andrewid-label.ipynb to check if they have local
-    # versions.
-    assignments = data['assignments']
-
-    assignment_files = [os.path.split(assignment)[-1]
-                        for assignment in assignments]
-    assignment_labels = [os.path.splitext(f)[0] for f in assignment_files]
-
-
-    headings = ['First name',
-                'Last name',
-                'Andrew ID',
-                'Overall']
-
-    # Add each assignment label
-    headings += assignment_labels
-
-    roster = get_roster()
-
-    ROWS = []
-    for d in roster:
-        ROW = []
-        ROW += [d['Preferred/First Name'],
-                d['Last Name'],
-                d['Andrew ID']]
-
-        grades = get_grades(d['Andrew ID'])
-        ROW += [round(grades['course-overall-grade'], 3)]
-
-        for label in assignment_labels:
-            asn = grades.get(label, None)
-            if asn:
-                if asn['overall'] is not None:
-                    ROW += [round(asn['overall'], 2)]
-                else:
-                    ROW += [None]
-            else:
-                ROW += [None]
-
-        ROWS += [ROW]
-
-    app.jinja_env.globals.update(isinstance=isinstance,
-                                 float=float)
+    """Render the gradebook for everyone on the roster.
+    With a background parameter, the grades are read into the grade index in
+    a job instead, and we redirect to its status."""
+    if request.args.get('background'):
+        job = JOBS.submit('gradebook', None,
+                          lambda job: compute_gradebook(get_roster(),
+                                                        job.progress) and None)
+        return redirect(url_for('job_status', id=job.id))
+
+    # The rows are loaded a page at a time from /api/gradebook.
     return render_template('gradebook.html',
-                           headings=headings,
-                           ROWS=ROWS)
+                           COURSE=COURSE,
+                           categories=COURSEDATA['categories'][0])
+
+
+@app.route('/api/gradebook')
+def api_gradebook():
+    """Return a page of the gradebook as json.
+    The parameters are:
+    page, per_page - the page (from 1) and the number of rows on it (50 by
+                     default, at most 500)
+    sort - first-name, last-name (the default), andrewid, overall, a category or
+           an assignment label
+    order - asc (the default) or desc. Students with no grade sort last.
+    category - only include the assignments in this category
+    status - missing or not-graded, to only include students with a missing
+             or not graded assignment
+    refresh - compute the gradebook again instead of using the cached one
+    """
+    import numpy as np
+
+    gb = get_gradebook(0 if request.args.get('refresh') else None)
+
+    category = request.args.get('category') or None
+    if category and category not in gb.categories:
+        return jsonify({'error': f'Unknown category {category}'}), 400
+    cols = np.flatnonzero([category is None or c == category
+                           for c in gb.assignment_categories])
+
+    rows = np.arange(len(gb.andrewids))
+    status = request.args.get('status') or None
+    if status == 'missing':
+        rows = np.flatnonzero(gb.missing[:, cols].any(axis=1))
+    elif status == 'not-graded':
+        rows = np.flatnonzero(gb.not_graded[:, cols].any(axis=1))
+    elif status:
+        return jsonify({'error': f'Unknown status {status}'}), 400
+
+    sort = request.args.get('sort', 'last-name')
+    order = request.args.get('order', 'asc')
+    names = {'first-name': 'Preferred/First Name', 'last-name': 'Last Name'}
+    if sort in names or sort == 'andrewid':
+        keys = [(gb.andrewids[i] if sort == 'andrewid'
+                 else gb.roster[i].get(names[sort], '')).lower()
+                for i in rows]
+        rows = rows[np.argsort(np.array(keys, dtype=str), kind='stable')]
+        if order == 'desc':
+            rows = rows[::-1]
+    else:
+        if sort == 'overall':
+            values = gb.overall
+        elif sort in gb.categories:
+            values = gb.category_grades[:, gb.categories.index(sort)]
+        elif sort in gb.labels:
+            values = gb.scores[:, gb.labels.index(sort)]
+        else:
+            return jsonify({'error': f'Unknown sort column {sort}'}), 400
+        values = values[rows]
+        # argsort puts nan last either way
+        rows = rows[np.argsort(-values if order == 'desc' else values,
+                               kind='stable')]
+
+    per_page = min(max(request.args.get('per_page', 50, type=int), 1), 500)
+    pages = max(1, -(-len(rows) // per_page))
+    page = min(max(request.args.get('page', 1, type=int), 1), pages)
+
+    def number(x, digits):
+        return None if np.isnan(x) else round(float(x), digits)
+
+    labels = [gb.labels[j] for j in cols]
+    page_rows = []
+    for i in rows[(page - 1) * per_page:page * per_page]:
+        entry = gb.roster[i]
+        page_rows += [{'andrewid': gb.andrewids[i],
+                       'first-name': entry.get('Preferred/First Name'),
+                       'last-name': entry.get('Last Name'),
+                       'overall': number(gb.overall[i], 3),
+                       'categories': {c: number(x, 3) for c, x
+                                      in zip(gb.categories,
+                                             gb.category_grades[i])},
+                       'grades': {gb.labels[j]: number(gb.scores[i, j], 2)
+                                  for j in cols},
+                       'missing': [gb.labels[j] for j in cols
+                                   if gb.missing[i, j]],
+                       'not-graded': [gb.labels[j] for j in cols
+                                      if gb.not_graded[i, j]]}]
+
+    return jsonify({'total': len(rows),
+                    'page': page,
+                    'pages': pages,
+                    'per_page': per_page,
+                    'sort': sort,
+                    'order': order,
+                    'category': category,
+                    'status': status,
+                    'labels': labels,
+                    'rows': page_rows})
+
+
+def _gradebook_columns():
+    """Return (columns, error) for the columns parameter of the request.
+    It is a comma separated list of Gradebook.COLUMNS, by default
+    name,overall,scores. If it has unknown columns, error is a 400 response
+    to return, and columns is None."""
+    columns = request.args.get('columns', 'name,overall,scores')
+    columns = [c.strip() for c in columns.split(',') if c.strip()]
+    unknown = [c for c in columns if c not in Gradebook.COLUMNS]
+    if unknown:
+        return None, (jsonify({'error': f'Unknown gradebook columns {unknown}. '  # NOQA
+                               f'Use some of {Gradebook.COLUMNS}.'}), 400)
+    return columns, None
+
+
+@app.route('/gradebook.csv')
+def gradebook_csv(chunk=100):
+    """Download the gradebook as csv.
+    The columns parameter selects the column groups, e.g.
+    /gradebook.csv?columns=name,overall,categories,rubric. The rows are
+    streamed to the client CHUNK students at a time. The gradebook is the
+    cached one, unless there is a refresh parameter."""
+    import csv
+    import io
+
+    columns, error = _gradebook_columns()
+    if error:
+        return error
+    gb = get_gradebook(0 if request.args.get('refresh') else None)
+
+    def generate():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(gb.headings(columns))
+        for n, row in enumerate(gb.table(columns), 1):
+            writer.writerow(row)
+            if n % chunk == 0:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+
+    return app.response_class(
+        generate(), mimetype='text/csv',
+        headers={'Content-Disposition':
+                 f'attachment; filename={COURSE}-gradebook.csv'})
+
+
+@app.route('/grade-reports.<fmt>')
+def grade_reports(fmt):
+    """Download the grade reports of everyone on the roster.
+    FMT is txt for plain text, with the reports streamed like
+    /gradebook.csv, or html for a page to print."""
+    roster = get_roster()
+    gb = compute_gradebook(roster)
+
+    if fmt == 'html':
+        reports = [(f"{d.get('Preferred/First Name', '')} "
+                    f"{d.get('Last Name', '')}", andrewid, report)
+                   for d, (andrewid, report) in zip(roster, gb.reports())]
+        return render_template('grade_reports.html', COURSE=COURSE,
+                               reports=reports)
+    elif fmt != 'txt':
+        return (f'Unknown format {fmt}', 404)
+
+    def generate():
+        for d, (andrewid, report) in zip(roster, gb.reports()):
+            title = (f"{d.get('Preferred/First Name', '')} "
+                     f"{d.get('Last Name', '')} ({andrewid})")
+            yield f'{title}\n{"=" * len(title)}\n{report}\n\n'
+
+    return app.response_class(
+        generate(), mimetype='text/plain',
+        headers={'Content-Disposition':
+                 f'attachment; filename={COURSE}-grade-reports.txt'})
+
+
+@app.route('/gradebook.xlsx')
+def gradebook_xlsx():
+    """Download the gradebook as an Excel file.
+    This takes the same columns parameter as /gradebook.csv, and needs
+    openpyxl. The workbook is written in write-only mode, so rows are not kept
+    as cell objects, but the file is a zip that is finished before it is
+    sent."""
+    import io
+    from flask import send_file
+    try:
+        import openpyxl
+    except ImportError:
+        return jsonify({'error': 'You need openpyxl to export xlsx. '
+                        'Try "pip install openpyxl".'}), 501
+
+    columns, error = _gradebook_columns()
+    if error:
+        return error
+    gb = get_gradebook(0 if request.args.get('refresh') else None)
+
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('gradebook')
+    ws.append(gb.headings(columns))
+    for row in gb.table(columns):
+        ws.append(row)
+
+    buf = io.BytesIO()
+    wb.save(buf)
+    buf.seek(0)
+    return send_file(buf, as_attachment=True,
+                     download_name=f'{COURSE}-gradebook.xlsx',
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')  # NOQA
@@ -1,9 +1,21 @@
+import sys
+import time
 import techela
 import threading
 import webbrowser
 
+# I assume you run the command like "python -m techela.app <course-label>"
+# optionally followed by --offline to use the course info saved last time.
+args = [arg for arg in sys.argv[1:] if arg != '--offline']
+if len(args) != 1:
+    raise Exception('Did you run "python -m techela.app <course-label>"')
+
+app = techela.create_app(args[0], offline='--offline' in sys.argv)
+# This is the CPU time since the interpreter started, i.e. the cold start.
+print(f'techela started in {time.process_time():.3f} seconds')
+
 port = 5543
 url = f"http://127.0.0.1:{port}"
 
 threading.Timer(1.25, lambda: webbrowser.open(url)).start()
-techela.app.run(port=port, debug=True, use_reloader=False)
+app.run(port=port, debug=True, use_reloader=False)
@@ -0,0 +1,165 @@
+"""A content-addressed store for the assignments archive.
+
+Every version of every submission used to be copied into
+assignments-archive/<label>/, and most of those copies are identical. The
+store keeps each unique notebook once, named by its sha256 digest, and a small
+manifest of versions for each (andrewid, label).
+
+The layout under the root directory is:
+
+blobs/ab/abcdef....ipynb - the notebooks, by digest
+manifests/<label>/<andrewid>.json - a list of versions, oldest first
+"""
+from datetime import datetime
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+from techela.atomic import copy_atomic, write_atomic
+
+
+def sha256_file(fname):
+    "Return the sha256 hex digest of the contents of FNAME."
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def copy_file(src, dst):
+    """Copy SRC to DST.
+    On filesystems that support it (btrfs, xfs, ...) this is a copy-on-write
+    clone that shares the data blocks, otherwise it is a regular copy. We do
+    not hardlink, because Jupyter saves notebooks in place, and grading the
+    file would change the archive copy too.
+    """
+    try:
+        import fcntl
+        FICLONE = 0x40049409
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        shutil.copymode(src, dst)
+    except (ImportError, OSError):
+        shutil.copy(src, dst)
+
+
+def _write_json(fname, data):
+    "Write DATA to FNAME atomically."
+    write_atomic(fname, json.dumps(data, indent=1).encode('utf-8'))
+
+
+class ArchiveStore:
+    "A content-addressed archive of submissions in the directory ROOT."
+
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+
+    def blob_path(self, digest):
+        "Return the path to the blob for DIGEST."
+        return os.path.join(self.root, 'blobs', digest[:2], digest + '.ipynb')
+
+    def manifest_path(self, andrewid, label):
+        "Return the path to the manifest of ANDREWID for LABEL."
+        return os.path.join(self.root, 'manifests', label, andrewid + '.json')
+
+    def versions(self, andrewid, label):
+        """Return the list of archived versions of ANDREWID for LABEL.
+        Each version is a dictionary with the digest, size, the time it was
+        archived and the name of the file it came from."""
+        fname = self.manifest_path(andrewid, label)
+        if not os.path.exists(fname):
+            return []
+        with open(fname, encoding='utf-8') as f:
+            return json.loads(f.read())
+
+    def latest(self, andrewid, label):
+        "Return the newest version of ANDREWID for LABEL or None."
+        versions = self.versions(andrewid, label)
+        return versions[-1] if versions else None
+
+    def put(self, andrewid, label, fname, digest=None):
+        """Archive FNAME as a version of ANDREWID for LABEL.
+        DIGEST is the sha256 of FNAME if you already know it. Nothing is added
+        if the newest version has the same content. Returns the digest.
+        """
+        digest = digest or sha256_file(fname)
+        blob = self.blob_path(digest)
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            copy_atomic(fname, blob, copy_file)
+
+        with self.lock:
+            versions = self.versions(andrewid, label)
+            if not versions or versions[-1]['digest'] != digest:
+                versions += [{'digest': digest,
+                              'size': os.path.getsize(blob),
+                              'archived': datetime.now().isoformat(" "),
+                              'source': os.path.basename(fname)}]
+                manifest = self.manifest_path(andrewid, label)
+                os.makedirs(os.path.dirname(manifest), exist_ok=True)
+                _write_json(manifest, versions)
+        return digest
+
+    def list(self, label):
+        "Return a dictionary of {andrewid: versions} for LABEL."
+        d = os.path.join(self.root, 'manifests', label)
+        if not os.path.isdir(d):
+            return {}
+        return {os.path.splitext(f)[0]: self.versions(os.path.splitext(f)[0],
+                                                      label)
+                for f in sorted(os.listdir(d)) if f.endswith('.json')}
+
+    def restore(self, andrewid, label, dest, version=-1):
+        """Copy a version of ANDREWID for LABEL to DEST.
+        VERSION is an index into the versions, the newest by default."""
+        digest = self.versions(andrewid, label)[version]['digest']
+        copy_file(self.blob_path(digest), dest)
+        return dest
+
+    def migrate(self, label):
+        """Move the files in the old <root>/<label>/ archive into the store.
+        The old files are deleted once they are stored."""
+        d = os.path.join(self.root, label)
+        if not os.path.isdir(d):
+            return
+        suffix = f'-{label}.ipynb'
+        for f in sorted(os.listdir(d)):
+            if f.endswith(suffix):
+                fname = os.path.join(d, f)
+                self.put(f[:-len(suffix)], label, fname)
+                os.remove(fname)
+        if not os.listdir(d):
+            os.rmdir(d)
+
+    def verify(self, workers=8):
+        """Check every blob against its digest, in parallel.
+        Returns a list of (digest, problem) for the bad ones, where problem is
+        'missing' for blobs in a manifest that do not exist, or 'corrupt'.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        digests = set()
+        manifests = os.path.join(self.root, 'manifests')
+        for label in (os.listdir(manifests) if os.path.isdir(manifests)
+                      else []):
+            for versions in self.list(label).values():
+                digests.update(v['digest'] for v in versions)
+        blobs = os.path.join(self.root, 'blobs')
+        for dirpath, dirnames, filenames in os.walk(blobs):
+            digests.update(os.path.splitext(f)[0] for f in filenames
+                           if f.endswith('.ipynb'))
+
+        def check(digest):
+            fname = self.blob_path(digest)
+            if not os.path.exists(fname):
+                return digest, 'missing'
+            if sha256_file(fname) != digest:
+                return digest, 'corrupt'
+            return None
+
+        with ThreadPoolExecutor(workers) as pool:
+            return [bad for bad in pool.map(check, sorted(digests)) if bad]
@@ -0,0 +1,43 @@
+"""Replacing files atomically.
+
+New content goes to a temporary file next to the destination, which is synced
+to disk and then renamed over it. Readers, and a crash, only ever see the old
+file or the whole new one. The temporary name has the thread id in it, so
+threads writing the same file do not trip over each other; the last one to
+finish wins.
+"""
+import contextlib
+import os
+import shutil
+import threading
+
+
+@contextlib.contextmanager
+def replacing(fname):
+    """Yield a temporary path to write the new content of FNAME to.
+    When the with block finishes, the temporary file replaces FNAME and keeps
+    its mode. If the block fails, FNAME is left alone."""
+    tmp = f'{fname}.{threading.get_ident()}.tmp'
+    try:
+        yield tmp
+        with open(tmp, 'r+b') as f:
+            os.fsync(f.fileno())
+        if os.path.exists(fname):
+            shutil.copymode(fname, tmp)
+        os.replace(tmp, fname)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def write_atomic(fname, content):
+    "Replace FNAME with the bytes CONTENT."
+    with replacing(fname) as tmp:
+        with open(tmp, 'wb') as f:
+            f.write(content)
+
+
+def copy_atomic(src, fname, copy=shutil.copyfile):
+    "Replace FNAME with a copy of SRC made by COPY(SRC, path)."
+    with replacing(fname) as tmp:
+        copy(src, tmp)
@@ -0,0 +1,130 @@
+"""Notebook email attachments.
+
+Notebooks with a lot of plots are big, and base64 makes them a third bigger
+again in an email. Relays are slow with, or refuse, messages of 10+ MB. Two
+things help, and both are optional:
+
+1. compact_notebook replaces the largest outputs with a short note until the
+notebook is under a size limit. This only changes what is sent; the file on
+disk keeps its outputs.
+
+2. attachment can gzip or zip the notebook. Compressed submissions are
+decompressed by `decompress' when they are collected.
+"""
+from email import encoders
+from email.mime.base import MIMEBase
+import gzip
+import io
+import json
+import os
+import zipfile
+
+from techela.atomic import write_atomic
+
+NOTE = '[This output was removed to make the email smaller.]'
+
+# suffix: mime type of the compressed attachments
+COMPRESSED = {'.gz': 'application/gzip',
+              '.zip': 'application/zip'}
+
+
+def _strip_output(output):
+    "Replace the content of OUTPUT with NOTE."
+    if output.get('output_type') == 'stream':
+        output['text'] = [NOTE]
+    elif output.get('output_type') == 'error':
+        output['traceback'] = [NOTE]
+    else:
+        output['data'] = {'text/plain': [NOTE]}
+        output['metadata'] = {}
+
+
+def compact_notebook(content, max_size=None, keep=2**10):
+    """Return the notebook bytes CONTENT, smaller than MAX_SIZE if possible.
+    The largest cell outputs are replaced by a note until the notebook fits.
+    Outputs smaller than KEEP bytes are left alone. CONTENT is returned as it
+    is when MAX_SIZE is None, it already fits or no output is big enough to
+    remove. Otherwise the number of outputs removed is saved in the
+    OUTPUTS-REMOVED metadata.
+    """
+    if not max_size or len(content) <= max_size:
+        return content
+
+    nb = json.loads(content.decode('utf-8'))
+    outputs = []
+    for cell in nb.get('cells', []):
+        for output in cell.get('outputs', []):
+            size = len(json.dumps(output))
+            if size >= keep:
+                outputs += [(size, output)]
+    outputs.sort(key=lambda x: -x[0])
+
+    size = len(content)
+    removed = 0
+    for osize, output in outputs:
+        if size <= max_size:
+            break
+        _strip_output(output)
+        size -= osize - len(json.dumps(output))
+        removed += 1
+
+    if not removed:
+        return content
+    nb['metadata']['OUTPUTS-REMOVED'] = removed
+    return json.dumps(nb).encode('utf-8')
+
+
+def attachment(content, filename, compression=None):
+    """Return a MIME attachment of the bytes CONTENT named FILENAME.
+    COMPRESSION is None, 'gzip' or 'zip'. Compressed attachments get a .gz or
+    .zip suffix on FILENAME."""
+    if compression == 'gzip':
+        content = gzip.compress(content, mtime=0)
+        filename += '.gz'
+    elif compression == 'zip':
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+            z.writestr(os.path.basename(filename), content)
+        content = buf.getvalue()
+        filename += '.zip'
+    elif compression:
+        raise Exception(f'Unknown attachment compression {compression}')
+
+    ctype = COMPRESSED.get(os.path.splitext(filename)[1],
+                           'application/octet-stream')
+    maintype, subtype = ctype.split('/', 1)
+    part = MIMEBase(maintype, subtype)
+    part.set_payload(content)
+    # Encode the payload using Base64
+    encoders.encode_base64(part)
+    # Set the filename parameter
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+    return part
+
+
+def compressed_name(fname):
+    """Return FNAME without its compression suffix, or None if it does not
+    have one."""
+    base, ext = os.path.splitext(fname)
+    return base if ext in COMPRESSED else None
+
+
+def decompress(fname, dest=None):
+    """Decompress the .gz or .zip file FNAME to DEST and delete FNAME.
+    DEST is FNAME without the suffix by default. A zip file should contain one
+    notebook. Returns DEST."""
+    dest = dest or compressed_name(fname)
+    if fname.endswith('.gz'):
+        with gzip.open(fname, 'rb') as f:
+            content = f.read()
+    else:
+        with zipfile.ZipFile(fname) as z:
+            names = [n for n in z.namelist() if n.endswith('.ipynb')]
+            if len(names) != 1:
+                raise Exception(f'{fname} should contain one notebook, '
+                                f'not {len(names)}')
+            content = z.read(names[0])
+
+    write_atomic(dest, content)
+    os.remove(fname)
+    return dest
@@ -0,0 +1,318 @@
+"""Benchmarks for the grading hot paths on a synthetic course.
+
+make_course builds a fake course with a roster, a course-files.json and
+graded notebooks for N students x M assignments. The benchmarks set techela
+up for it offline, and time the functions and routes the instructors wait on.
+Assignments are returned to a local SMTP sink, so no email is sent.
+
+Run it like this, and compare the json between versions:
+
+python -m techela.bench --students 200 --assignments 30 --output before.json
+"""
+import argparse
+import contextlib
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import socketserver
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+CATEGORIES = [["homework", "quiz", "exam"], [0.3, 0.3, 0.4]]
+
+
+def make_notebook(size=10, grade=None, grader='grader'):
+    """Return a notebook dictionary with about SIZE kB of cell output.
+    GRADE is the overall grade, or None for an ungraded notebook."""
+    data = ''.join(random.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789+/')
+                   for i in range(64))
+    png = data * (size * 1024 // len(data))
+    cells = [{'cell_type': 'markdown', 'metadata': {},
+              'source': ['# A synthetic assignment']},
+             {'cell_type': 'code', 'execution_count': 1, 'metadata': {},
+              'outputs': [{'data': {'image/png': png,
+                                    'text/plain': ['<Figure>']},
+                           'metadata': {}, 'output_type': 'display_data'}],
+              'source': ['import matplotlib.pyplot as plt\n',
+                         'plt.plot([1, 2, 3])']}]
+    metadata = {'org': {'GRADER': grader},
+                'TURNED-IN': {'timestamp': '2019-09-01 12:00:00'}}
+    if grade is not None:
+        cells += [{'cell_type': 'markdown',
+                   'metadata': {'type': 'comment', 'content': 'Nice plot.'},
+                   'source': ['Nice plot.']}]
+        metadata['grade'] = {'overall': grade, 'technical': 'A',
+                             'presentation': 'B'}
+    return {'cells': cells, 'metadata': metadata,
+            'nbformat': 4, 'nbformat_minor': 2}
+
+
+def make_course(root, students=50, assignments=10, size=10, submitted=0.9,
+                graded=0.8, label='bench-course', seed=0):
+    """Make a synthetic course in the directory ROOT.
+    There are STUDENTS students and ASSIGNMENTS assignments, all but the last
+    one past due. A SUBMITTED fraction of the notebooks exist, and a GRADED
+    fraction of those have a grade. Notebooks have about SIZE kB of output.
+
+    The course directory is ROOT/course and the Box folder is ROOT/box.
+    Returns the course directory, use it like
+    create_app(label, offline=True, coursedir=coursedir).
+    """
+    random.seed(seed)
+    coursedir = os.path.join(root, 'course')
+    box = os.path.join(root, 'box')
+    for d in [coursedir, os.path.join(box, 'submissions'),
+              os.path.join(box, 'assignments')]:
+        os.makedirs(d, exist_ok=True)
+
+    andrewids = [f'student{i:04d}' for i in range(students)]
+    with open(os.path.join(box, 'roster.csv'), 'w', encoding='utf-8',
+              newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Andrew ID', 'Preferred/First Name', 'Last Name'])
+        for i, andrewid in enumerate(andrewids):
+            writer.writerow([andrewid, f'First{i}', f'Last{i}'])
+
+    files = {'lectures': [], 'lecture_keywords': [], 'solutions': [],
+             'announcements': '', 'assignments': {}}
+    for j in range(assignments):
+        alabel = f'assignment-{j:02d}'
+        duedate = ('2099-12-31 23:59:59' if j == assignments - 1
+                   else f'2019-{j % 12 + 1:02d}-15 23:59:59')
+        files['assignments'][f'assignments/{alabel}.ipynb'] = {
+            'label': alabel, 'duedate': duedate, 'points': random.randint(1, 5),
+            'category': CATEGORIES[0][j % len(CATEGORIES[0])],
+            'grader': 'grader', 'rubric': 'default'}
+        d = os.path.join(box, 'assignments', alabel)
+        os.makedirs(d, exist_ok=True)
+        for andrewid in andrewids:
+            if random.random() > submitted:
+                continue
+            grade = (round(random.random(), 3) if random.random() < graded
+                     else None)
+            with open(os.path.join(d, f'{andrewid}-{alabel}.ipynb'), 'w',
+                      encoding='utf-8') as f:
+                f.write(json.dumps(make_notebook(size, grade)))
+
+    coursedata = {'title': 'A synthetic course', 'label': label,
+                  'submit-email': 'submit@example.com',
+                  'course-url': 'http://127.0.0.1:9/',
+                  'course-raw-url': 'http://127.0.0.1:9/',
+                  'instructor': 'Grader', 'instructor-email': 'grader',
+                  'admin-names': ['Grader'], 'admin-andrewids': ['grader'],
+                  'categories': CATEGORIES,
+                  'rubrics': {'default': [['technical', 'presentation'],
+                                          [0.9, 0.1]]},
+                  'local-box-path': box,
+                  'smtp-ssl': False, 'smtp-rate': None}
+    for fname, data in [('course-data.json', coursedata),
+                        ('course-files.json', files),
+                        ('techela.json', {'ANDREWID': 'grader',
+                                          'NAME': 'Grader'})]:
+        with open(os.path.join(coursedir, fname), 'w', encoding='utf-8') as f:
+            f.write(json.dumps(data, indent=1))
+    return coursedir
+
+
+# * A local SMTP sink
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    "Accept everything and keep count of the messages."
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost sink')
+        for line in self.rfile:
+            command = line.decode('ascii', errors='replace').strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply('250 localhost')
+            elif command.startswith('DATA'):
+                self.reply('354 go ahead')
+                for line in self.rfile:
+                    if line in (b'.\r\n', b'.\n'):
+                        break
+                with self.server.lock:
+                    self.server.messages += 1
+                self.reply('250 ok')
+            elif command.startswith('QUIT'):
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """An SMTP server on localhost that throws the messages away.
+    Use it as a context manager; port is the port it listens on."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.port = self.server_address[1]
+        self.messages = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+# * Benchmarks
+
+
+def timeit(fn, repeat=5):
+    """Time FN() REPEAT times.
+    The first call is reported separately since it fills the caches."""
+    times = []
+    for i in range(repeat + 1):
+        t0 = time.perf_counter()
+        fn()
+        times += [time.perf_counter() - t0]
+    return {'first': times[0],
+            'min': min(times[1:]),
+            'median': statistics.median(times[1:]),
+            'mean': statistics.mean(times[1:]),
+            'repeat': repeat}
+
+
+def run(students=50, assignments=10, size=10, submitted=0.9, graded=0.8,
+        repeat=5, root=None):
+    """Make a synthetic course and benchmark it.
+    The course is made in a temporary directory unless ROOT is given. Returns
+    a json-friendly dictionary of the parameters, environment and results in
+    seconds.
+    """
+    import techela
+
+    params = {'students': students, 'assignments': assignments, 'size': size,
+              'submitted': submitted, 'graded': graded, 'repeat': repeat}
+    tmp = None
+    if root is None:
+        root = tmp = tempfile.mkdtemp(prefix='techela-bench-')
+    try:
+        t0 = time.perf_counter()
+        coursedir = make_course(root, students, assignments, size, submitted,
+                                graded)
+        setup = time.perf_counter() - t0
+
+        with SMTPSink() as sink:
+            with open(os.path.join(coursedir, 'course-data.json'),
+                      encoding='utf-8') as f:
+                coursedata = json.loads(f.read())
+            coursedata['smtp-relay'] = '127.0.0.1'
+            coursedata['smtp-port'] = sink.port
+            with open(os.path.join(coursedir, 'course-data.json'), 'w',
+                      encoding='utf-8') as f:
+                f.write(json.dumps(coursedata, indent=1))
+
+            app = techela.create_app(coursedata['label'], offline=True,
+                                     coursedir=coursedir)
+            client = app.test_client()
+
+            andrewid = techela.get_roster()[0]['Andrew ID']
+            label = 'assignment-00'
+
+            def is_graded(andrewid):
+                fname = os.path.join(coursedata['local-box-path'],
+                                     'assignments', label,
+                                     f'{andrewid}-{label}.ipynb')
+                return (os.path.exists(fname)
+                        and techela.read_notebook_metadata(fname).graded)
+
+            # a graded notebook to return
+            returned = [d['Andrew ID'] for d in techela.get_roster()
+                        if is_graded(d['Andrew ID'])]
+            if not returned:
+                raise Exception(f'Nothing is graded in {label}')
+            returned = returned[0]
+
+            def get(url, status=200):
+                r = client.get(url)
+                if r.status_code != status:
+                    raise Exception(f'{url} returned {r.status_code}')
+                # streamed responses are only made when they are read
+                r.get_data()
+
+            benchmarks = [
+                ('get_roster', techela.get_roster),
+                ('get_grades', lambda: techela.get_grades(andrewid)),
+                # refresh, so the gradebook is computed each time
+                ('gradebook',
+                 lambda: get('/api/gradebook?refresh=1&per_page=500')),
+                ('grade_assignment',
+                 lambda: get(f'/grade-assignment/{label}')),
+                ('grade_reports', lambda: get('/grade-reports.txt')),
+                ('return_one',
+                 lambda: get(f'/return/{returned}/{label}?force=1', 204))]
+
+            results = {}
+            # The routes print a lot, which is not what we want to measure.
+            with open(os.devnull, 'w') as devnull:
+                with contextlib.redirect_stdout(devnull):
+                    for name, fn in benchmarks:
+                        results[name] = timeit(fn, repeat)
+            params['messages'] = sink.messages
+            if techela.MAILER:
+                techela.MAILER.close()
+    finally:
+        if tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    try:
+        version = techela.get_version()
+    except Exception:
+        version = None
+    return {'techela': version,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'params': params,
+            'setup': setup,
+            'results': results}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m techela.bench',
+        description='Benchmark techela on a synthetic course.')
+    parser.add_argument('--students', type=int, default=50)
+    parser.add_argument('--assignments', type=int, default=10)
+    parser.add_argument('--size', type=int, default=10,
+                        help='kB of output in each notebook')
+    parser.add_argument('--submitted', type=float, default=0.9,
+                        help='fraction of notebooks that exist')
+    parser.add_argument('--graded', type=float, default=0.8,
+                        help='fraction of notebooks that are graded')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--root',
+                        help='make the course here and keep it')
+    parser.add_argument('--output', help='write the json here')
+    args = parser.parse_args(args)
+
+    results = run(args.students, args.assignments, args.size, args.submitted,
+                  args.graded, args.repeat, args.root)
+    text = json.dumps(results, indent=1)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+"""Downloading course files.
+
+All the files techela gets from the course site go through a Downloader. It
+keeps a few HTTP connections open per host, so a burst of downloads does not
+do a TCP and TLS handshake for each file. It also keeps the last copy of each
+url in a cache directory with its ETag and Last-Modified headers, and asks
+the server for the file only if it changed. An unchanged file costs a 304
+response, and is copied from the cache.
+
+Files are written with `techela.atomic', so a failed download never leaves a
+partial file.
+
+The layout of the cache directory is:
+
+<sha256 of url> - the content
+<sha256 of url>.json - the url and the headers we revalidate with
+"""
+from collections import namedtuple
+import hashlib
+import http.client
+import json
+import os
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from techela.atomic import copy_atomic, write_atomic
+from techela.metrics import METRICS
+
+# path is where the file was saved, changed is False when the server said our
+# copy is current, and status is the http status (None if we did not ask).
+Download = namedtuple('Download', ['path', 'changed', 'status'])
+
+
+class Downloader:
+    """Download urls with up to SIZE idle connections per host, caching them
+    in CACHE_DIR."""
+
+    def __init__(self, cache_dir, size=4, timeout=30, redirects=5):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.timeout = timeout
+        self.redirects = redirects
+        # (scheme, host, port): [idle connections]
+        self.idle = {}
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def cache_path(self, url):
+        "Return the path to the cached content of URL."
+        return os.path.join(self.cache_dir,
+                            hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def validators(self, url):
+        """Return the cached headers of URL, or {} if it is not cached."""
+        fname = self.cache_path(url)
+        try:
+            with open(fname + '.json', encoding='utf-8') as f:
+                cached = json.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+        if cached.get('url') != url or not os.path.exists(fname):
+            return {}
+        return cached
+
+    # ** connections
+
+    def _checkout(self, key):
+        with self.lock:
+            if self.idle.get(key):
+                return self.idle[key].pop(), True
+        scheme, host, port = key
+        HTTPConnection = (http.client.HTTPSConnection if scheme == 'https'
+                          else http.client.HTTPConnection)
+        return HTTPConnection(host, port, timeout=self.timeout), False
+
+    def _checkin(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, url, headers=None):
+        """GET URL with HEADERS and return (status, headers, content).
+        Redirects are followed. Connection problems raise URLError like
+        urllib does."""
+        headers = dict(headers or {})
+        for i in range(self.redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            if urllib.request.getproxies().get(parts.scheme):
+                # We leave proxies to urllib, without connection reuse.
+                return self._urlopen(url, headers)
+            key = (parts.scheme, parts.hostname,
+                   parts.port or (443 if parts.scheme == 'https' else 80))
+            path = urllib.parse.urlunsplit(('', '', parts.path or '/',
+                                            parts.query, ''))
+            METRICS.count('network_fetches')
+            for attempt in range(2):
+                conn, reused = self._checkout(key)
+                try:
+                    conn.request('GET', path, headers=headers)
+                    r = conn.getresponse()
+                    content = r.read()
+                except (OSError, http.client.HTTPException) as e:
+                    conn.close()
+                    # An idle connection may have been closed by the server,
+                    # so that is worth one more try on a new connection.
+                    if reused and attempt == 0:
+                        continue
+                    raise urllib.error.URLError(e)
+                if r.will_close:
+                    conn.close()
+                else:
+                    self._checkin(key, conn)
+                break
+
+            if r.status in (301, 302, 303, 307, 308):
+                url = urllib.parse.urljoin(url, r.headers['Location'])
+                continue
+            return r.status, r.headers, content
+        raise urllib.error.URLError(f'Too many redirects for {url}')
+
+    def _urlopen(self, url, headers):
+        req = urllib.request.Request(url, headers=headers)
+        METRICS.count('network_fetches')
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as r:
+                return r.status, r.headers, r.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return 304, e.headers, b''
+            raise
+
+    def close(self):
+        "Close the idle connections."
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    # ** downloads
+
+    def get(self, url, fname=None):
+        """Download URL to FNAME, and return a Download.
+        With FNAME None the file is only updated in the cache, and the path of
+        the cached copy is returned. Errors from the server raise HTTPError,
+        and connection problems URLError, like urlretrieve.
+        """
+        cache = self.cache_path(url)
+        cached = self.validators(url)
+        headers = {}
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last-modified'):
+            headers['If-Modified-Since'] = cached['last-modified']
+
+        status, response_headers, content = self.request(url, headers)
+        if status == 304 and cached:
+            METRICS.count('downloads_not_modified')
+            changed = False
+        elif status == 200:
+            write_atomic(cache, content)
+            write_atomic(cache + '.json',
+                         json.dumps({'url': url,
+                                     'etag': response_headers.get('ETag'),
+                                     'last-modified':
+                                     response_headers.get('Last-Modified')})
+                         .encode('utf-8'))
+            changed = True
+        else:
+            raise urllib.error.HTTPError(url, status,
+                                         f'Unable to download {url}',
+                                         response_headers, None)
+
+        if fname is None:
+            return Download(cache, changed, status)
+        self.copy(url, fname)
+        return Download(fname, changed, status)
+
+    def copy(self, url, fname):
+        """Copy our cached copy of URL to FNAME without using the network.
+        Returns a Download, or None if URL is not cached."""
+        cache = self.cache_path(url)
+        if not os.path.exists(cache):
+            return None
+        os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+        copy_atomic(cache, fname)
+        return Download(fname, False, None)
@@ -0,0 +1,133 @@
+"""A small in-process job queue for long admin operations.
+
+Jobs run on a bounded pool of threads. Submitting an operation for a label
+while the same one is queued or running returns the existing job instead of
+starting it twice. Finished jobs are kept in a short history with their
+durations.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import itertools
+import threading
+import time
+import traceback
+
+
+class Job:
+    """An OPERATION on LABEL that runs FN(job, *ARGS).
+    FN can put whatever it likes in the job's progress dictionary, and its
+    return value is saved in result. FN runs in a copy of the context the job
+    was made in."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, operation, label, fn, args):
+        self.id = next(self._ids)
+        self.operation = operation
+        self.label = label
+        self.fn = fn
+        self.args = args
+        self.context = contextvars.copy_context()
+        self.status = 'queued'
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    @property
+    def active(self):
+        return self.status in ('queued', 'running')
+
+    @property
+    def duration(self):
+        "Seconds the job ran for (so far), or None if it has not started."
+        if self.started is None:
+            return None
+        return (self.finished or time.time()) - self.started
+
+    def run(self):
+        self.status = 'running'
+        self.started = time.time()
+        try:
+            self.result = self.context.run(self.fn, self, *self.args)
+            self.status = 'done'
+        except Exception as e:
+            traceback.print_exc()
+            self.error = f'{type(e).__name__}: {e}'
+            self.status = 'failed'
+        finally:
+            self.finished = time.time()
+            self.done.set()
+
+    def wait(self, timeout=None):
+        "Wait for the job to finish. Returns False if TIMEOUT ran out first."
+        return self.done.wait(timeout)
+
+    def as_dict(self):
+        "Return the state of the job as a json-friendly dictionary."
+        return {'id': self.id,
+                'operation': self.operation,
+                'label': self.label,
+                'status': self.status,
+                'progress': self.progress,
+                'error': self.error,
+                'submitted': self.submitted,
+                'started': self.started,
+                'finished': self.finished,
+                'duration': self.duration}
+
+
+class JobQueue:
+    "Run jobs on WORKERS threads, keeping the last HISTORY finished jobs."
+
+    def __init__(self, workers=2, history=100):
+        self.pool = ThreadPoolExecutor(workers)
+        self.jobs = {}
+        self.history = deque(maxlen=history)
+        self.lock = threading.Lock()
+
+    def submit(self, operation, label, fn, *args):
+        """Queue FN(job, *ARGS) as OPERATION on LABEL and return the job.
+        If that operation is already queued or running for LABEL, return that
+        job instead."""
+        with self.lock:
+            for job in self.jobs.values():
+                if job.active and (job.operation, job.label) == (operation,
+                                                                 label):
+                    return job
+            job = Job(operation, label, fn, args)
+            self.jobs[job.id] = job
+        self.pool.submit(self._run, job)
+        return job
+
+    def _run(self, job):
+        job.run()
+        with self.lock:
+            self.history.append(job.id)
+            # forget the jobs that dropped out of the history
+            keep = set(self.history)
+            for id in [id for id, j in self.jobs.items()
+                       if not j.active and id not in keep]:
+                del self.jobs[id]
+
+    def get(self, id):
+        "Return the job with ID or None."
+        with self.lock:
+            return self.jobs.get(id, None)
+
+    def latest(self, operation, label):
+        "Return the newest job for OPERATION on LABEL or None."
+        with self.lock:
+            jobs = [job for job in self.jobs.values()
+                    if (job.operation, job.label) == (operation, label)]
+        return max(jobs, key=lambda job: job.id) if jobs else None
+
+    def all(self):
+        "Return all the jobs we know about, newest first."
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return sorted(jobs, key=lambda job: -job.id)
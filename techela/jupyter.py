@@ -0,0 +1,142 @@
+"""One long-lived Jupyter notebook server per directory.
+
+Starting `jupyter notebook' for every file takes seconds and leaves a server
+running for each one. Instead we start one server for a directory the first
+time a notebook in it is opened, and open the others as urls on it.
+"""
+import atexit
+import os
+import secrets
+import socket
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import webbrowser
+
+from techela.metrics import METRICS
+
+
+class JupyterServer:
+    """A Jupyter notebook server for the directory ROOT.
+    The server listens on a free port on localhost, and uses a random token.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.token = secrets.token_hex(24)
+        self.port = None
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def url(self, path=''):
+        "Return the url for PATH on the server, with the token."
+        return (f'http://127.0.0.1:{self.port}/{path}?'
+                + urllib.parse.urlencode({'token': self.token}))
+
+    def healthy(self):
+        "Return True if the server is running and answering requests."
+        if self.proc is None or self.proc.poll() is not None:
+            return False
+        try:
+            with urllib.request.urlopen(self.url('api/status'),
+                                        timeout=2) as r:
+                return r.status == 200
+        except (urllib.error.URLError, OSError):
+            return False
+
+    def start(self, timeout=60, attempts=3):
+        """Start the server and wait until it answers.
+        The port we pick can be taken before jupyter binds it. Jupyter is told
+        not to look for another one, so it exits, and we try again with a new
+        port, up to ATTEMPTS times."""
+        for attempt in range(attempts):
+            with socket.socket() as s:
+                s.bind(('127.0.0.1', 0))
+                self.port = s.getsockname()[1]
+
+            # NotebookApp is Notebook < 7, and ServerApp is Notebook 7.
+            cmd = ["jupyter", "notebook", "--no-browser",
+                   f"--port={self.port}", "--NotebookApp.port_retries=0",
+                   "--ServerApp.port_retries=0", f"--notebook-dir={self.root}"]
+            env = dict(os.environ, JUPYTER_TOKEN=self.token)
+            METRICS.count('subprocesses')
+            # We never read the output, and an unread pipe can fill up and
+            # block the server, so it goes nowhere.
+            self.proc = subprocess.Popen(cmd, env=env, cwd=self.root,
+                                         stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL,
+                                         stdin=subprocess.DEVNULL)
+
+            t0 = time.time()
+            while not self.healthy():
+                if self.proc.poll() is not None:
+                    break
+                if time.time() - t0 > timeout:
+                    self.stop()
+                    raise Exception(f'jupyter notebook did not start in {timeout} s')  # NOQA
+                time.sleep(0.25)
+            else:
+                return
+        raise Exception(f'jupyter notebook exited with {self.proc.returncode}')
+
+    def ensure_running(self):
+        "Start the server unless it is already running."
+        with self.lock:
+            if not self.healthy():
+                self.stop()
+                self.start()
+
+    def open(self, path=None):
+        """Open the notebook at PATH in a browser tab and return its url.
+        PATH must be in the server root. With no PATH, open the file browser.
+        """
+        self.ensure_running()
+        if path is None:
+            url = self.url('tree')
+        else:
+            rel = os.path.relpath(os.path.abspath(path), self.root)
+            if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+                raise Exception(f'{path} is not in {self.root}')
+            url = self.url('notebooks/'
+                           + urllib.parse.quote(rel.replace(os.sep, '/')))
+        webbrowser.open_new_tab(url)
+        return url
+
+    def stop(self):
+        "Stop the server if it is running."
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        self.proc = None
+
+
+SERVERS = {}
+_LOCK = threading.Lock()
+
+
+def get_server(root):
+    "Return the JupyterServer for ROOT, making it if needed."
+    root = os.path.abspath(os.path.expanduser(root))
+    with _LOCK:
+        if root not in SERVERS:
+            SERVERS[root] = JupyterServer(root)
+        return SERVERS[root]
+
+
+def open_notebook(path, root):
+    """Open the notebook PATH on the server for the directory ROOT.
+    With PATH None, the file browser for ROOT is opened."""
+    return get_server(root).open(path)
+
+
+@atexit.register
+def stop_servers():
+    "Stop all the servers."
+    for server in list(SERVERS.values()):
+        server.stop()
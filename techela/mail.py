@@ -0,0 +1,139 @@
+"""Sending email for techela.
+
+A Mailer keeps a few SMTP connections open and reuses them for many
+messages, instead of doing a new connection and TLS handshake for each one.
+A TokenBucket limits how fast messages are sent to the relay.
+
+For testing you can point a Mailer at a local SMTP server, e.g.
+
+python -m aiosmtpd -n -l localhost:8025
+
+and Mailer('localhost', 8025, ssl=False).
+"""
+import smtplib
+import threading
+import time
+
+from techela.metrics import METRICS
+
+
+class TokenBucket:
+    """Allow RATE events per second on average, in bursts of up to CAPACITY."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        "Wait until there is a token, and take it."
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_transient(err):
+    """Return True if ERR is worth retrying on a new connection.
+    These are dropped connections, network errors and 4xx responses."""
+    if isinstance(err, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(err, smtplib.SMTPAuthenticationError):
+        return False
+    if isinstance(err, smtplib.SMTPResponseException):
+        return 400 <= err.smtp_code < 500
+    if isinstance(err, smtplib.SMTPException):
+        return False
+    return isinstance(err, OSError)
+
+
+class Mailer:
+    """Send messages through HOST:PORT on up to SIZE reused connections.
+    If USER is given, each connection logs in with USER and PASSWORD. RATE
+    is the maximum number of messages per second (None for no limit).
+    Transient failures are retried up to RETRIES times on a new connection.
+    """
+
+    def __init__(self, host, port=465, ssl=True, user=None, password=None,
+                 size=1, rate=None, burst=1, retries=3, timeout=60):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.user = user
+        self.password = password
+        self.retries = retries
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = []
+        self.lock = threading.Lock()
+        self.sent = 0
+
+    def connect(self):
+        "Return a new, logged in connection."
+        SMTP = smtplib.SMTP_SSL if self.ssl else smtplib.SMTP
+        conn = SMTP(self.host, port=self.port, timeout=self.timeout)
+        if self.user:
+            conn.login(self.user, self.password)
+        return conn
+
+    def _checkout(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return self.connect()
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except OSError:
+            pass
+
+    def send(self, msg):
+        "Send the email MSG, waiting for the rate limit and a free connection."
+        if self.bucket:
+            self.bucket.acquire()
+
+        with self.slots:
+            for attempt in range(self.retries + 1):
+                conn = None
+                try:
+                    conn = self._checkout()
+                    conn.send_message(msg)
+                except OSError as e:
+                    transient = is_transient(e)
+                    if conn is not None and transient:
+                        self._discard(conn)
+                    elif conn is not None:
+                        # The message was refused, the connection is fine.
+                        with self.lock:
+                            self.idle.append(conn)
+                    if not transient or attempt == self.retries:
+                        raise
+                else:
+                    with self.lock:
+                        self.idle.append(conn)
+                        self.sent += 1
+                    METRICS.count('smtp_sends')
+                    return
+                print(f'Retrying to send {msg["Subject"]}')
+                time.sleep(2 ** attempt)
+
+    def close(self):
+        "Close the idle connections."
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            try:
+                conn.quit()
+            except (smtplib.SMTPException, OSError):
+                self._discard(conn)
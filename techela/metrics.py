@@ -0,0 +1,161 @@
+"""Counters and request timings for techela.
+
+The app records how long each route takes, and the code counts the expensive
+things it does (notebooks opened and parsed, network fetches, subprocesses,
+emails) with `count'. Counts are attributed to the route of the request they
+happen in; work on other threads is attributed to the request that started it
+if the thread runs in a copy of its context (see `contextvars'), and to no
+route otherwise.
+
+`render' returns everything in the Prometheus text format, which is served on
+/metrics. With `init_app(app, header=True)' each response also gets a
+Server-Timing header with its duration and counts.
+"""
+import bisect
+import contextlib
+import contextvars
+import threading
+import time
+
+COUNTERS = {'notebooks_opened': 'Notebook files opened and parsed.',
+            'notebook_bytes': 'Bytes of notebook files parsed.',
+            'json_decode_seconds': 'Seconds spent decoding notebook json.',
+            'network_fetches': 'Files fetched over the network.',
+            'downloads_not_modified': 'Fetches answered with 304 Not Modified.',  # NOQA
+            'subprocesses': 'Subprocesses launched.',
+            'smtp_sends': 'Emails sent.'}
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# The route of the current request and a dictionary of its counts.
+_ROUTE = contextvars.ContextVar('techela_route', default='')
+_COUNTS = contextvars.ContextVar('techela_counts', default=None)
+
+
+class Metrics:
+    "Counters by (name, route), and request durations by route."
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        # (route, method, status): count
+        self.requests = {}
+        # route: [bucket counts, count, sum]
+        self.durations = {}
+
+    def count(self, name, value=1):
+        "Add VALUE to the counter NAME for the current route."
+        key = (name, _ROUTE.get())
+        counts = _COUNTS.get()
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            if counts is not None:
+                counts[name] = counts.get(name, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        "Add the seconds spent in the with block to the counter NAME."
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.count(name, time.perf_counter() - t0)
+
+    def observe(self, route, method, status, seconds):
+        "Record a request to ROUTE that took SECONDS."
+        with self.lock:
+            key = (route, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            if route not in self.durations:
+                self.durations[route] = [[0] * len(BUCKETS), 0, 0.0]
+            histogram = self.durations[route]
+            i = bisect.bisect_left(BUCKETS, seconds)
+            if i < len(BUCKETS):
+                histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    def render(self):
+        "Return the metrics in the Prometheus text format."
+        with self.lock:
+            counters = dict(self.counters)
+            requests = dict(self.requests)
+            durations = {route: [list(h[0]), h[1], h[2]]
+                         for route, h in self.durations.items()}
+
+        lines = ['# HELP techela_requests_total Requests by route, method and status.',  # NOQA
+                 '# TYPE techela_requests_total counter']
+        for (route, method, status), n in sorted(requests.items()):
+            lines += [f'techela_requests_total{{route="{route}",'
+                      f'method="{method}",status="{status}"}} {n}']
+
+        lines += ['# HELP techela_request_duration_seconds Request durations by route.',  # NOQA
+                  '# TYPE techela_request_duration_seconds histogram']
+        for route, (buckets, n, total) in sorted(durations.items()):
+            cumulative = 0
+            for le, b in zip(BUCKETS, buckets):
+                cumulative += b
+                lines += [f'techela_request_duration_seconds_bucket'
+                          f'{{route="{route}",le="{le}"}} {cumulative}']
+            lines += [f'techela_request_duration_seconds_bucket'
+                      f'{{route="{route}",le="+Inf"}} {n}',
+                      f'techela_request_duration_seconds_sum'
+                      f'{{route="{route}"}} {total}',
+                      f'techela_request_duration_seconds_count'
+                      f'{{route="{route}"}} {n}']
+
+        for name, doc in COUNTERS.items():
+            lines += [f'# HELP techela_{name}_total {doc}',
+                      f'# TYPE techela_{name}_total counter']
+            for (cname, route), value in sorted(counters.items()):
+                if cname == name:
+                    lines += [f'techela_{name}_total{{route="{route}"}} {value}']  # NOQA
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        "Forget everything."
+        with self.lock:
+            self.counters.clear()
+            self.requests.clear()
+            self.durations.clear()
+
+
+METRICS = Metrics()
+count = METRICS.count
+timer = METRICS.timer
+
+
+def init_app(app, header=False):
+    """Time the requests to the flask APP.
+    If HEADER is truthy, add a Server-Timing header to each response. The
+    METRICS_HEADER setting in the app config overrides HEADER."""
+    from flask import g, request
+
+    @app.before_request
+    def _start():
+        g.metrics_start = time.perf_counter()
+        _ROUTE.set(request.url_rule.rule if request.url_rule
+                   else '<unmatched>')
+        _COUNTS.set({})
+
+    @app.after_request
+    def _finish(response):
+        if 'metrics_start' not in g:
+            return response
+        seconds = time.perf_counter() - g.metrics_start
+        METRICS.observe(_ROUTE.get(), request.method, response.status_code,
+                        seconds)
+        if app.config.get('METRICS_HEADER', header):
+            timings = [f'total;dur={seconds * 1000:.1f}']
+            timings += [f'{name};desc="{value:g}"'
+                        for name, value in sorted(_COUNTS.get().items())]
+            response.headers['Server-Timing'] = ', '.join(timings)
+        return response
+
+    @app.teardown_request
+    def _reset(exc):
+        # Threads are reused for requests, so we do not leave these behind.
+        _ROUTE.set('')
+        _COUNTS.set(None)
+
+    return app
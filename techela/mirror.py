@@ -0,0 +1,110 @@
+"""A local mirror of the course repo, kept in sync with content hashes.
+
+The pre-commit hook of the course repo puts the sha256 of every file in the
+lectures, assignments and solutions directories in the "hashes" entry of
+course-files.json. The mirror keeps the same hashes for the copies it has (in
+the cache of a Downloader), so syncing only downloads the files whose hash
+changed, and a file whose hash matches can be used without asking the server.
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import contextvars
+import json
+import os
+import threading
+
+from techela.archive import sha256_file
+from techela.atomic import write_atomic
+
+
+class Mirror:
+    """The files of the course at BASE_URL, in the cache of DOWNLOADER.
+    The hashes of the mirrored files are saved in MANIFEST."""
+
+    def __init__(self, base_url, downloader, manifest):
+        self.base_url = base_url
+        self.downloader = downloader
+        self.manifest = manifest
+        self.lock = threading.Lock()
+        self.hashes = {}
+        # path: the expected hash, for files that did not have it when we
+        # last downloaded them
+        self.mismatched = {}
+        if os.path.exists(manifest):
+            with open(manifest, encoding='utf-8') as f:
+                self.hashes = json.loads(f.read())
+
+    def path(self, url):
+        """Return the path of URL in the course repo, or None if it is not in
+        the course."""
+        if url.startswith(self.base_url):
+            return url[len(self.base_url):]
+        return None
+
+    def current(self, path, remote):
+        """Return True if we have the version of PATH in REMOTE, a dictionary
+        of {path: hash} from course-files.json."""
+        digest = self.hashes.get(path)
+        return (digest is not None and remote.get(path) == digest
+                and os.path.exists(self.downloader.cache_path(self.base_url
+                                                              + path)))
+
+    def pending(self, remote):
+        """Return the paths in REMOTE that are out of date, except the ones
+        that did not have their hash in REMOTE when we last downloaded them.
+        Trying those again will not help until the hash changes."""
+        with self.lock:
+            mismatched = dict(self.mismatched)
+        return [path for path in sorted(remote)
+                if not self.current(path, remote)
+                and mismatched.get(path) != remote[path]]
+
+    def save(self):
+        "Save the hashes to the manifest file."
+        with self.lock:
+            text = json.dumps(self.hashes, indent=1, sort_keys=True)
+        write_atomic(self.manifest, text.encode('utf-8'))
+
+    def fetch(self, path, digest):
+        """Download PATH into the mirror and check it has the hash DIGEST."""
+        result = self.downloader.get(self.base_url + path)
+        actual = sha256_file(result.path)
+        if actual != digest:
+            with self.lock:
+                self.mismatched[path] = digest
+            raise Exception(f'{path} has hash {actual}, expected {digest}')
+        with self.lock:
+            self.hashes[path] = digest
+            self.mismatched.pop(path, None)
+        return result.changed
+
+    def sync(self, remote, workers=8, progress=None):
+        """Make the mirror match REMOTE, a dictionary of {path: hash}.
+        Only the files whose hash changed are downloaded, WORKERS at a time.
+        Files that are no longer in REMOTE are forgotten. PROGRESS is an
+        optional dictionary that is updated as files are done.
+        """
+        changed = [path for path in sorted(remote)
+                   if not self.current(path, remote)]
+        if progress is None:
+            progress = {}
+        progress.update(total=len(changed), done=0, downloaded=0, failed=0,
+                        errors=[])
+
+        with self.lock:
+            for path in [path for path in self.hashes if path not in remote]:
+                del self.hashes[path]
+
+        with ThreadPoolExecutor(workers) as pool:
+            futures = {pool.submit(contextvars.copy_context().run,
+                                   self.fetch, path, remote[path]): path
+                       for path in changed}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    progress['downloaded'] += 1
+                except Exception as e:
+                    progress['failed'] += 1
+                    progress['errors'] += [f'{futures[future]}: {e}']
+                progress['done'] += 1
+        self.save()
+        return progress
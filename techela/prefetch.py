@@ -0,0 +1,22 @@
+"""Download the course files and the images they use, e.g. before class.
+
+Run it like this:
+
+python -m techela.prefetch <course-label>
+
+Add --force to download files you already have again, and --offline to use
+the course info saved the last time.
+"""
+import sys
+import techela
+
+args = [arg for arg in sys.argv[1:] if arg not in ('--offline', '--force')]
+if len(args) != 1:
+    raise Exception('Did you run "python -m techela.prefetch <course-label>"')
+
+techela.create_app(args[0], offline='--offline' in sys.argv)
+progress = techela.prefetch_course(force='--force' in sys.argv)
+
+print(f"Downloaded {progress['downloaded']} files, {progress['failed']} failed.")  # NOQA
+for error in progress['errors']:
+    print(error)
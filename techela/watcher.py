@@ -0,0 +1,144 @@
+"""Watch a directory for new or changed files.
+
+On Linux we use inotify to wake up as soon as something changes. Synced
+folders (e.g. Box Sync) do not always generate inotify events, so the
+directory is also polled every few seconds. Files are only reported once their
+size and mtime have stopped changing for a while, so we do not pick up files
+the sync client is still writing.
+"""
+import fnmatch
+import os
+import select
+import sys
+import threading
+import time
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+
+
+def inotify_fd(directory):
+    """Return an inotify file descriptor watching DIRECTORY, or None if inotify
+    is not available."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+
+class Watcher:
+    """Call CALLBACK(path) for new or changed files in DIRECTORY.
+    Only file names matching PATTERN are considered. A file is reported when
+    its size and mtime have not changed for DEBOUNCE seconds. The directory is
+    polled every INTERVAL seconds, and right away on inotify events unless
+    INOTIFY is falsy. Files already in the directory when the watcher starts
+    count as new.
+    """
+
+    def __init__(self, directory, callback, pattern='*.ipynb', debounce=5,
+                 interval=10, inotify=True):
+        self.directory = directory
+        self.callback = callback
+        self.pattern = pattern
+        self.debounce = debounce
+        self.interval = interval
+        self.inotify = inotify
+        # name: (mtime, size) of the version that was reported
+        self.seen = {}
+        # name: ((mtime, size), time we first saw that version)
+        self.pending = {}
+        self.errors = []
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def scan(self):
+        """Look at the directory once and report the files that settled.
+        Returns the number of files still waiting to settle."""
+        now = time.monotonic()
+        current = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file() and fnmatch.fnmatch(entry.name,
+                                                       self.pattern):
+                    st = entry.stat()
+                    current[entry.name] = (st.st_mtime_ns, st.st_size)
+
+        for name in list(self.seen):
+            if name not in current:
+                del self.seen[name]
+        for name in list(self.pending):
+            if name not in current:
+                del self.pending[name]
+
+        for name, sig in current.items():
+            if self.seen.get(name) == sig:
+                continue
+            if name not in self.pending or self.pending[name][0] != sig:
+                self.pending[name] = (sig, now)
+            elif now - self.pending[name][1] >= self.debounce:
+                del self.pending[name]
+                self.seen[name] = sig
+                try:
+                    self.callback(os.path.join(self.directory, name))
+                except Exception as e:
+                    print(f'Error handling {name}: {e}')
+                    self.errors += [f'{name}: {e}']
+        return len(self.pending)
+
+    def run(self):
+        "Watch until stop is called."
+        fd = inotify_fd(self.directory) if self.inotify else None
+        try:
+            while not self.stopped.is_set():
+                try:
+                    waiting = self.scan()
+                except OSError as e:
+                    print(f'Unable to scan {self.directory}: {e}')
+                    waiting = 0
+                timeout = min(self.interval,
+                              self.debounce) if waiting else self.interval
+                if fd is None:
+                    self.stopped.wait(timeout)
+                    continue
+                ready, _, _ = select.select([fd], [], [], timeout)
+                if ready:
+                    # We only use the events to wake up, then drain them.
+                    try:
+                        while os.read(fd, 65536):
+                            pass
+                    except BlockingIOError:
+                        pass
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    def start(self):
+        "Start watching in a background thread."
+        if self.thread is None or not self.thread.is_alive():
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    def running(self):
+        "Return True if the watcher thread is running."
+        return self.thread is not None and self.thread.is_alive()
+
+    def stop(self):
+        "Stop watching."
+        self.stopped.set()